@@ -1,3 +1,4 @@
+import cv2 as cv
 import kornia as KR
 import kornia.feature as KF
 import matplotlib.pyplot as plt
@@ -7,7 +8,7 @@ import torch
 import config
 from kornia_utils import *
 from opt_covering import *
-from utils import update_stats_map_static, append_update_stats_map_static, timer_label_decorator
+from utils import update_stats_map_static, append_update_stats_map_static, timer_label_decorator, kps_to_xy
 from config import CartesianConfig
 
 AFFNET_RECTIFY_TAG = "affnet_rectify"
@@ -30,14 +31,30 @@ class PointsStyle:
     size: float
 
 
+def get_kpts_hom(cv_kpts):
+    """
+    :param cv_kpts: list of cv.KeyPoint
+    :return: torch.Tensor(N, 3) - homogeneous coordinates of the keypoints (float32)
+    """
+    pts = kps_to_xy(cv_kpts)
+    return torch.from_numpy(np.hstack((pts, np.ones((pts.shape[0], 1), dtype=np.float32))))
+
+
+def get_kpts_affine_transformed(cv_kpts, aff_map):
+    """
+    :param cv_kpts: list of cv.KeyPoint
+    :param aff_map: torch.Tensor(2, 3)
+    :return: torch.Tensor(N, 2) - aff_map applied on the keypoints (same as get_kpts_hom(cv_kpts) @ aff_map.T,
+    but without materializing the homogeneous coordinates)
+    """
+    pts = torch.from_numpy(kps_to_xy(cv_kpts))
+    return pts @ aff_map[:, :2].T + aff_map[:, 2]
+
+
 def round_and_clamp_coords_torch(coords, max_0_excl, max_1_excl):
 
-    # round and write elsewhere, then work in-place
-    coords = torch.round(coords)
-    torch.clamp(coords[:, 0], 0, max_0_excl - 1, out=coords[:, 0])
-    torch.clamp(coords[:, 1], 0, max_1_excl - 1, out=coords[:, 1])
-    coords = coords.to(torch.long)
-    return coords
+    bounds = torch.tensor([max_0_excl - 1, max_1_excl - 1], device=coords.device, dtype=coords.dtype)
+    return coords.round().clamp_(min=0).minimum(bounds).long()
 
 
 # NOTE : also basically version of utils.get_kpts_normals, but for torch!!!
@@ -49,10 +66,10 @@ def get_kpts_components_indices(components_indices_np, valid_components_dict, la
     coords = round_and_clamp_coords_torch(laffs_no_scale[0, :, :, 2], components_indices_np.shape[1], components_indices_np.shape[0])
 
     components_indices_deviced = torch.from_numpy(components_indices_np)#.to(device)
-    components_indices_linear = components_indices_deviced[coords[:, 1], coords[:, 0]]
-    components_indices_linear_and_invalid = torch.ones_like(coords[:, 0]) * -1
-    for valid_component in valid_components_dict:
-        components_indices_linear_and_invalid[components_indices_linear == valid_component] = valid_component
+    components_indices_linear = components_indices_deviced[coords[:, 1], coords[:, 0]].to(torch.long)
+    valid_components = torch.tensor(list(valid_components_dict), dtype=torch.long)
+    valid_mask = torch.isin(components_indices_linear, valid_components)
+    components_indices_linear_and_invalid = torch.where(valid_mask, components_indices_linear, -1)
 
     Timer.end_check_point("get_kpts_components_indices")
 
@@ -68,65 +85,96 @@ def get_rotation_matrices(angles):
 
 
 def compose_lin_maps(ts, phis, lambdas, psis):
+    """
+    Inverse of decompose_lin_maps_lambda_psi_t_phi, i.e. lambdas * R(psis) @ [[ts, 0], [0, 1]] @ R(phis),
+    with the 4 entries written out directly (no R_psis @ T_ts @ R_phis products)
+    :param ts: torch.Tensor(D1, D2) (or a scalar tensor)
+    :param phis: torch.Tensor(D1, D2) (or a scalar tensor)
+    :param lambdas: torch.Tensor(D1, D2) or None (=> 1 / sqrt(ts))
+    :param psis: torch.Tensor(D1, D2) or None (=> 0)
+    :return: lin_maps torch.Tensor(D1, D2, 2, 2), lambdas
+    """
 
+    ts = torch.atleast_2d(ts)
+    phis = torch.atleast_2d(phis)
     if lambdas is None:
         lambdas = 1.0 / torch.sqrt(ts)
-        lambdas = lambdas.repeat(1, 1, 1, 1)
     if psis is None:
         psis = torch.zeros_like(phis)
 
-    R_psis = get_rotation_matrices(psis)
-    R_phis = get_rotation_matrices(phis)
+    cos_psis, sin_psis = torch.cos(psis), torch.sin(psis)
+    cos_phis, sin_phis = torch.cos(phis), torch.sin(phis)
+
+    lin_maps = torch.stack((ts * cos_psis * cos_phis - sin_psis * sin_phis,
+                            -ts * cos_psis * sin_phis - sin_psis * cos_phis,
+                            ts * sin_psis * cos_phis + cos_psis * sin_phis,
+                            -ts * sin_psis * sin_phis + cos_psis * cos_phis), dim=-1)
+    lin_maps = lambdas[..., None, None] * lin_maps.reshape(*lin_maps.shape[:-1], 2, 2)
+    return lin_maps, lambdas
 
-    T_ts = torch.zeros_like(ts)
-    T_ts = T_ts.repeat(1, 1, 2, 2)
-    T_ts[:, :, 0, 0] = ts
-    T_ts[:, :, 1, 1] = 1
 
-    lin_maps = lambdas * R_psis @ T_ts @ R_phis
-    return lin_maps, lambdas, R_psis, T_ts, R_phis
+def det_2x2(A):
+    """
+    :param A: torch.Tensor(..., 2, 2)
+    :return: torch.Tensor(...) - a * d - b * c, no need for the LU based torch.det
+    """
+    return A[..., 0, 0] * A[..., 1, 1] - A[..., 0, 1] * A[..., 1, 0]
 
 
-# TODO handle CUDA
-@timer_label_decorator("decompose_lin_maps", tags=[Timer.NOT_NESTED_TAG])
-def decompose_lin_maps_lambda_psi_t_phi(l_maps, asserts=True):
+def svd_2x2(l_maps):
     """
+    Closed-form SVD of a batch of 2x2 matrices, i.e. a drop-in replacement of torch.svd(l_maps)
+    which avoids the LAPACK/cuSOLVER dispatch for the tiny matrices
+    M = R(psi) @ diag(s_0, s_1) @ R(phi) with s_0 = Q + R, s_1 = Q - R
     :param l_maps: torch.Tensor(D1, D2, 2, 2)
-        - i.e. it can be either (B, C, 2, 2) => e.g. (1, 1000, 2, 2) or
-        (H, W, 2, 2) => it should work independently
-    :param asserts: if additional asserts should be performed (rotation matrix invariants, ts matrix structure)
-    :return: lambdas, psis, ts, phis
+    :return: U, s, V - the same semantics as torch.svd (s >= 0 in descending order, l_maps = U @ diag(s) @ V^T)
     """
 
-    assert len(l_maps.shape) == 4
+    a = l_maps[..., 0, 0]
+    b = l_maps[..., 0, 1]
+    c = l_maps[..., 1, 0]
+    d = l_maps[..., 1, 1]
 
-    # NOTE for now just disallow CUDA
-    assert l_maps.device == torch.device('cpu')
+    e = (a + d) / 2
+    f = (a - d) / 2
+    g = (c + b) / 2
+    h = (c - b) / 2
 
-    U, s, V = torch.svd(l_maps)
-    V = torch.transpose(V, dim0=2, dim1=3)
+    q = torch.sqrt(e * e + h * h)
+    r = torch.sqrt(f * f + g * g)
+    s_0 = q + r
+    s_1 = q - r
 
-    lambdas = torch.ones(l_maps.shape[:2])
+    a_1 = torch.atan2(g, f)
+    a_2 = torch.atan2(h, e)
+    psi = (a_2 + a_1) / 2
+    phi = (a_2 - a_1) / 2
 
-    def assert_decomposition():
+    cos_psi, sin_psi = torch.cos(psi), torch.sin(psi)
+    cos_phi, sin_phi = torch.cos(phi), torch.sin(phi)
 
-        d = torch.diag_embed(s)
-        product = lambdas[:, :, None, None] * U @ d @ V
-        # NOTE relaxed from atol=1e-05 to atol=1e-04, maybe the matrix difference should be used here
-        close_cond = torch.allclose(product, l_maps, rtol=1e-04, atol=1e-04)
-        if not close_cond:
-            mask = ~torch.isclose(product, l_maps, rtol=1e-04, atol=1e-05)
-            mask = mask.max(dim=2).values.max(dim=2).values[0].to(float)
-            arg_max = mask.argmax()
-            print("error on data: [{}] vs. [{}]".format(product[0, arg_max], l_maps[0, arg_max]))
-            print("error: {}".format(product[0, arg_max] - l_maps[0, arg_max]))
-        assert close_cond
+    # s_1 < 0 => s_1 <- -s_1 and V^T <- diag(1, -1) @ V^T
+    sign_1 = 1.0 - 2.0 * (s_1 < 0).to(l_maps.dtype)
 
-    assert_decomposition()
+    U = torch.stack((torch.stack((cos_psi, -sin_psi), dim=-1),
+                     torch.stack((sin_psi, cos_psi), dim=-1)), dim=-2)
+    V = torch.stack((torch.stack((cos_phi, sign_1 * sin_phi), dim=-1),
+                     torch.stack((-sin_phi, sign_1 * cos_phi), dim=-1)), dim=-2)
+    s = torch.stack((s_0, s_1 * sign_1), dim=-1)
+    return U, s, V
 
-    if asserts:
-        assert torch.all(torch.sgn(s[:, :, 0]) == torch.sgn(s[:, :, 1]))
-        assert torch.all(s[:, :, 0] != 0)
+
+@torch.jit.script
+def _decompose_core(l_maps):
+    """
+    Pure tensor body of decompose_lin_maps_lambda_psi_t_phi, scripted so that the many tiny pointwise ops
+    on (D1, D2, 2, 2) tensors can be fused
+    :param l_maps: torch.Tensor(D1, D2, 2, 2)
+    :return: lambdas, psis, ts, phis, U, s, V (l_maps = lambdas * U @ diag(s) @ V, s = [t, 1])
+    """
+
+    U, s, V = svd_2x2(l_maps)
+    V = V.transpose(-2, -1)
 
     # TODO this is probably useless as factor will be 1
     factor = torch.sgn(s[:, :, :1])
@@ -135,67 +183,76 @@ def decompose_lin_maps_lambda_psi_t_phi(l_maps, asserts=True):
 
     # lambda <- s[1]
     # s <- [[t, 0], [0, 1]], t >= 1
-    lambdas = s[:, :, 1].clone()
+    lambdas = s[:, :, 1]
     s = s / s[:, :, 1:]
 
-    assert_decomposition()
-
-    if asserts:
-        assert torch.all(s[:, :, 0] >= 1)
-        assert torch.all(s[:, :, 1] == 1)
-
-    dets_u = torch.det(U)
-    dets_v = torch.det(V)
-    if asserts:
-        #assert torch.allclose(dets_v, dets_u, atol=1e-07)
-        assert torch.allclose(torch.abs(dets_v), torch.tensor(1.0), atol=1e-07)
-        assert torch.allclose(torch.abs(dets_u), torch.tensor(1.0), atol=1e-07)
-
     # it could be that det U[:, :, i] == det V[:, :, i] == -1, therefore I need to negate row(U, 0) and column(V, 0) -> two reflections
-    factor_rows_columns = torch.where(dets_v > 0.0, 1.0, -1.0)[:, :, None]
-    U[:, :, :, 0] = factor_rows_columns * U[:, :, :, 0]
-    V[:, :, 0, :] = factor_rows_columns * V[:, :, 0, :]
-
-    assert_decomposition()
-
-    dets_u = torch.det(U)
-    dets_v = torch.det(V)
-    # if asserts:
-    #     print("Foo")
-        # assert torch.allclose(dets_v, dets_u, atol=1e-07)
-        # assert torch.allclose(dets_v, torch.tensor(1.0), atol=1e-07)
+    dets_v = det_2x2(V)
+    factor_rows_columns = 1.0 - 2.0 * (dets_v <= 0.0).to(l_maps.dtype)
+    factor_rows_columns = torch.stack((factor_rows_columns, torch.ones_like(factor_rows_columns)), dim=-1)
+    U = U * factor_rows_columns[:, :, None, :]
+    V = V * factor_rows_columns[:, :, :, None]
 
     # phi in (0, pi), if not, V <- -V and U <- -U
-    phi_norm_factor = torch.where(V[:, :, :1, 1:] > 0, -1.0, 1.0)
+    phi_norm_factor = 1.0 - 2.0 * (V[:, :, :1, 1:] > 0).to(l_maps.dtype)
     V = V * phi_norm_factor
     U = U * phi_norm_factor
 
-    def assert_rotation(A, angle):
-        sins_ang = torch.sin(angle)
-#        if asserts:
-            # print("This is fine")
-            # assert torch.allclose(sins_ang, -A[:, :, 0, 1], atol=1e-03)
-            # assert torch.allclose(sins_ang, A[:, :, 1, 0], atol=1e-03)
-            # assert torch.allclose(A[:, :, 1, 1], A[:, :, 0, 0], atol=1e-05)
-
     phis = torch.arccos(torch.clamp(V[:, :, 0, 0], -1.0, 1.0))
-    assert_rotation(V, phis)
-
     psis = torch.arcsin(-torch.clamp(U[:, :, 0, 1], -1.0, 1.0))
-    assert_rotation(U, psis)
-
     ts = s[:, :, 0]
 
-    assert_decomposition()
+    return lambdas, psis, ts, phis, U, s, V
+
+
+@timer_label_decorator("decompose_lin_maps", tags=[Timer.NOT_NESTED_TAG])
+def decompose_lin_maps_lambda_psi_t_phi(l_maps, asserts=True):
+    """
+    :param l_maps: torch.Tensor(D1, D2, 2, 2)
+        - i.e. it can be either (B, C, 2, 2) => e.g. (1, 1000, 2, 2) or
+        (H, W, 2, 2) => it should work independently
+    :param asserts: if additional asserts should be performed (decomposition, rotation matrix invariants, ts matrix structure)
+    :return: lambdas, psis, ts, phis
+    """
+
+    assert len(l_maps.shape) == 4
+
+    lambdas, psis, ts, phis, U, s, V = _decompose_core(l_maps)
+
+    if asserts:
+        assert torch.all(s[:, :, 0] >= 1)
+        assert torch.all(s[:, :, 1] == 1)
+
+        one = torch.tensor(1.0, device=l_maps.device, dtype=l_maps.dtype)
+        assert torch.allclose(torch.abs(det_2x2(V)), one, atol=1e-07)
+        assert torch.allclose(torch.abs(det_2x2(U)), one, atol=1e-07)
+
+        d = torch.diag_embed(s)
+        product = lambdas[:, :, None, None] * U @ d @ V
+        # NOTE relaxed from atol=1e-05 to atol=1e-04, maybe the matrix difference should be used here
+        close_cond = torch.allclose(product, l_maps, rtol=1e-04, atol=1e-04)
+        if not close_cond:
+            mask = ~torch.isclose(product, l_maps, rtol=1e-04, atol=1e-05)
+            mask = mask.max(dim=2).values.max(dim=2).values[0].to(float)
+            arg_max = mask.argmax()
+            print("error on data: [{}] vs. [{}]".format(product[0, arg_max], l_maps[0, arg_max]))
+            print("error: {}".format(product[0, arg_max] - l_maps[0, arg_max]))
+        assert close_cond
 
     return lambdas, psis, ts, phis
 
 
 def draw(ts, phis, color, size, ax):
 
-    ts_logs = torch.log(ts)
-    xs = torch.cos(phis) * ts_logs
-    ys = torch.sin(phis) * ts_logs
+    # plain numpy - the data go to matplotlib anyway
+    if torch.is_tensor(ts):
+        ts = ts.detach().cpu().numpy()
+    if torch.is_tensor(phis):
+        phis = phis.detach().cpu().numpy()
+
+    ts_logs = np.log(ts)
+    xs = np.cos(phis) * ts_logs
+    ys = np.sin(phis) * ts_logs
 
     ax.plot(xs, ys, 'o', color=color, markersize=size)
 
@@ -219,32 +276,30 @@ def prepare_plot(max_radius: float, unit_radius: float, ax):
 
 def get_aff_map(t, phi, component_mask, invert_first):
 
-    lin_map, T_t, R_phi = compose_lin_maps(t, phi)[0]
+    lin_map, _ = compose_lin_maps(t, phi, lambdas=None, psis=None)
 
     assert invert_first, "current impl needs invert_first to be set to True"
 
-    aff_map = torch.zeros((1, 2, 3))
+    aff_map = torch.zeros((1, 2, 3), device=lin_map.device, dtype=lin_map.dtype)
     aff_map[:, :2, :2] = lin_map
 
-    coords = torch.where(component_mask)
-    min_x = coords[1].min()
-    max_x = coords[1].max()
-    min_y = coords[0].min()
-    max_y = coords[0].max()
+    min_x, max_x, min_y, max_y = get_bounding_box_of_mask(component_mask)
 
     corner_pts = torch.tensor([[min_x, min_y],
                                [min_x, max_y],
                                [max_x, max_y],
-                               [max_x, min_y]], dtype=torch.float)[None]
+                               [max_x, min_y]], dtype=torch.float, device=component_mask.device)[None]
 
     H = KR.geometry.convert_affinematrix_to_homography(aff_map)
     corner_pts_new = KR.geometry.transform_points(H, corner_pts)
 
-    aff_map[:, :, 2] = -torch.tensor([corner_pts_new[0, :, 0].min(), corner_pts_new[0, :, 1].min()])
+    mins = corner_pts_new[0].min(dim=0).values
+    aff_map[:, :, 2] = -mins
 
-    new_w = int((corner_pts_new[0, :, 0].max() - corner_pts_new[0, :, 0].min()).item())
-    new_h = int((corner_pts_new[0, :, 1].max() - corner_pts_new[0, :, 1].min()).item())
-    return aff_map, new_h, new_w, lin_map, T_t, R_phi
+    # single transfer for both extents
+    new_w, new_h = (corner_pts_new[0].max(dim=0).values - mins).tolist()
+    new_w, new_h = int(new_w), int(new_h)
+    return aff_map, new_h, new_w, lin_map
 
 
 def plot_space_of_tilts(label, img_name, valid_component, normal_index, tilt_r, max_tilt_r, point_styles: list, really_show=True):
@@ -275,18 +330,26 @@ def visualize_LAF_custom(img, LAF, img_idx=0, color='r', title="", **kwargs):
         plt.show(block=False)
 
 
+def get_bounding_box_of_mask(mask):
+    """
+    Bounding box via row/column reductions, i.e. without materializing the coordinates of all the pixels of the mask
+    :param mask: torch.Tensor(H, W)
+    :return: min_x, max_x, min_y, max_y (inclusive)
+    """
+    mask = mask != 0
+    xs = torch.nonzero(mask.any(dim=0))[:, 0]
+    ys = torch.nonzero(mask.any(dim=1))[:, 0]
+    return xs[0], xs[-1], ys[0], ys[-1]
+
+
 # TODO document
 def get_corners_of_mask(mask):
-    coords = torch.where(mask)
-    min_x = coords[1].min()
-    max_x = coords[1].max()
-    min_y = coords[0].min()
-    max_y = coords[0].max()
+    min_x, max_x, min_y, max_y = get_bounding_box_of_mask(mask)
 
     corner_pts = torch.tensor([[min_x, min_y],
                                [min_x, max_y],
                                [max_x, max_y],
-                               [max_x, min_y]], dtype=torch.float).T[None]
+                               [max_x, min_y]], dtype=torch.float, device=mask.device).T[None]
     return corner_pts
 
 
@@ -305,10 +368,12 @@ def warp_affine(img_t, mask, affine_map, mode='biliner'):
     #corner_pts_new = KR.geometry.transform_points(H, corner_pts)
     corner_pts_new = affine_map[:, :, :2] @ corner_pts
 
-    affine_map[:, :, 2] = -torch.tensor([corner_pts_new[0, 0, :].min(), corner_pts_new[0, 1, :].min()])
+    mins = corner_pts_new[0].min(dim=1).values
+    affine_map[:, :, 2] = -mins
 
-    new_w = int((corner_pts_new[0, 0, :].max() - corner_pts_new[0, 0, :].min()).item())
-    new_h = int((corner_pts_new[0, 1, :].max() - corner_pts_new[0, 1, :].min()).item())
+    # single transfer for both extents
+    new_w, new_h = (corner_pts_new[0].max(dim=1).values - mins).tolist()
+    new_w, new_h = int(new_w), int(new_h)
 
     warped_img = KR.geometry.warp_affine(img_t, affine_map, dsize=(new_h, new_w), mode=mode)
     return warped_img, new_h, new_w
@@ -376,12 +441,13 @@ def warp_image(img, tilt, phi, img_mask, blur_param=0.8, invert_first=True, warp
     return img_tilt, affine_transform
 
 
-def winning_centers(covering_params: CoveringParams, data, config, return_cover_idxs=False):
+def winning_centers(covering_params: CoveringParams, data, config, return_cover_idxs=False, device=None):
     """
     :param covering_params:
     :param data:
     :param config:
     :param return_cover_idxs:
+    :param device: see opt_covering.vote
     :return: winning_centers, cover_idx (=None if return_cover_idxs == False)
         winning_centers: rows of with 2 columns - (tau_i, phi_i)
         cover_idx: index of centers for the data points
@@ -397,7 +463,8 @@ def winning_centers(covering_params: CoveringParams, data, config, return_cover_
                                           fraction_th=covering_fraction_th,
                                           iter_th=covering_max_iter,
                                           conf=config,
-                                          return_cover_idxs=return_cover_idxs)
+                                          return_cover_idxs=return_cover_idxs,
+                                          device=device)
 
     return ret_winning_centers, cover_idx
 
@@ -472,9 +539,8 @@ def get_covering_transformations(data_all_ts, data_all_phis, config):
 
 def get_mask(img_warped_t, aff_maps_inv, current_component, img_data):
     mesh = torch.where(img_warped_t[0, 0] > -500)
-    mesh_tensor = torch.vstack((mesh[1], mesh[0], torch.ones(mesh[0].shape[0]))).type(torch.float32).t()
-    inverted_pxs = aff_maps_inv.repeat(mesh_tensor.shape[0], 1, 1) @ mesh_tensor.unsqueeze(2)
-    inverted_pxs = inverted_pxs.squeeze(2)
+    mesh_tensor = torch.vstack((mesh[1], mesh[0], torch.ones(mesh[0].shape[0], device=mesh[0].device))).type(torch.float32).t()
+    inverted_pxs = mesh_tensor @ aff_maps_inv[0].T
     inverted_pxs = torch.round(inverted_pxs).to(torch.long)
     # DEBUG dimensions
     mask_inv_pxs = (inverted_pxs[:, 1] < img_data.img.shape[0]) & (inverted_pxs[:, 1] >= 0) & \
@@ -506,9 +572,7 @@ def get_effective_sift_mask(img_warped_t, aff_maps_inv, current_component, img_d
 
 # TODO use this to modularize the pipeline
 def get_mask_kpts(cv_kpt, aff_map_back, img_data, current_component):
-    kps_t = torch.tensor([kp.pt + (1,) for kp in cv_kpt])
-    kpt_s_back = aff_map_back.repeat(kps_t.shape[0], 1, 1) @ kps_t.unsqueeze(2)
-    kpt_s_back = kpt_s_back.squeeze(2)
+    kpt_s_back = get_kpts_affine_transformed(cv_kpt, aff_map_back[0])
 
 
     kpt_s_back_int = torch.round(kpt_s_back).to(torch.long)
@@ -538,7 +602,8 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
                      mask_cmp, ts, phis,
                      current_component, normal_index,
                      config, params_key, stats_map,
-                     kpts_struct: KptStruct):
+                     kpts_struct: KptStruct,
+                     components_indices_t=None):
 
     init_label = Timer.start_check_point("add_covering_kps init", tags=[AFFNET_RECTIFY_TAG, ADD_COVERING_KPS_TAG])
 
@@ -561,7 +626,9 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
         return
 
     if current_component is not None:
-        mask_img_component = torch.from_numpy(img_data.components_indices == current_component)
+        if components_indices_t is None:
+            components_indices_t = torch.from_numpy(img_data.components_indices)
+        mask_img_component = components_indices_t == current_component
     else:
         mask_img_component = torch.ones(img_data.img.shape[:2])
 
@@ -576,6 +643,12 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
         ts_phis = get_covering_transformations(ts_component, phis_component, config)
 
     append_update_stats_map_static(["per_img_stats", params_key, img_name, "affnet_warps_per_component"], len(ts_phis), stats_map)
+
+    # concatenated just once after the loop
+    descs_chunks = [kpts_struct.descs]
+    laffs_chunks = [kpts_struct.laffs]
+    reprojected_laffs_chunks = [kpts_struct.reprojected_laffs]
+
     for t_phi in ts_phis:
 
         img_warped_t, aff_map = warp_image(t_img_all, t_phi[0].item(), t_phi[1].item(), mask_img_component, invert_first=True)
@@ -603,9 +676,8 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
 
         fk2_label = Timer.start_check_point("affnet filtering keypoints per component 2", tags=[AFFNET_RECTIFY_TAG, ADD_COVERING_KPS_TAG])
 
-        kps_t = torch.tensor([kp.pt + (1,) for kp in kps_warped])
-        kpt_s_back = aff_maps_inv.repeat(kps_t.shape[0], 1, 1) @ kps_t.unsqueeze(2)
-        kpt_s_back = kpt_s_back.squeeze(2)
+        # no need to replicate the affine map for every keypoint
+        kpt_s_back = get_kpts_affine_transformed(kps_warped, aff_maps_inv[0])
 
         laffs_final[0, :, :, 2] = kpt_s_back
 
@@ -638,20 +710,19 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
 
         mask_cmp = mask_cmp.to(torch.bool)
 
-        kps = []
-        for i, kp in enumerate(kps_warped):
-            if mask_cmp[i]:
-                kp.pt = (kpt_s_back[i][0].item(), kpt_s_back[i][1].item())
-                kps.append(kp)
+        valid_idx = mask_cmp.nonzero(as_tuple=True)[0].tolist()
+        kps = [kps_warped[i] for i in valid_idx]
+        for kp, (x, y) in zip(kps, kpt_s_back[valid_idx].tolist()):
+            kp.pt = (x, y)
         descs = descs_warped[mask_cmp.numpy()]
 
         laffs_final = laffs_final[:, mask_cmp]
         laffs_reprojected = laffs_reprojected[:, mask_cmp]
 
         kpts_struct.kps.extend(kps)
-        kpts_struct.descs = np.vstack((kpts_struct.descs, descs))
-        kpts_struct.laffs = torch.cat((kpts_struct.laffs, laffs_final), 1)
-        kpts_struct.reprojected_laffs = torch.cat((kpts_struct.reprojected_laffs, laffs_reprojected), 1)
+        descs_chunks.append(descs)
+        laffs_chunks.append(laffs_final)
+        reprojected_laffs_chunks.append(laffs_reprojected)
 
         # unscaled data etc. is just for stats or even for visualizations
         # TODO refactor - do_stats(_and_viz)..
@@ -689,6 +760,10 @@ def add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
                 PointsStyle(ts=ts_affnet_out, phis=phis_affnet_out, color="y", size=0.5),
             ])
 
+    kpts_struct.descs = np.vstack(descs_chunks)
+    kpts_struct.laffs = torch.cat(laffs_chunks, 1)
+    kpts_struct.reprojected_laffs = torch.cat(reprojected_laffs_chunks, 1)
+
 
 def visualize_sot(ts, phis, mask_in_or_no_component, img_name, covering, img_data):
 
@@ -737,9 +812,10 @@ def get_kpts_component_indices(affnet_no_clustering, unrectified_laffs, img_data
 
 
 @timer_label_decorator("laffs decomposition affnet identity", tags=[AFFNET_RECTIFY_TAG])
-def get_ts_phis(affnet_lin_maps):
-    _, _, ts, phis = decompose_lin_maps_lambda_psi_t_phi(affnet_lin_maps)
-    return ts, phis
+def get_ts_phis(affnet_lin_maps, device=torch.device('cpu')):
+    # the decomposition runs over all the keypoints, the masks derived from ts, phis are CPU bound (img_data)
+    _, _, ts, phis = decompose_lin_maps_lambda_psi_t_phi(affnet_lin_maps.to(device))
+    return ts.cpu(), phis.cpu()
 
 
 @timer_label_decorator(tags=[AFFNET_RECTIFY_TAG, "main"])
@@ -783,7 +859,7 @@ def affnet_rectify(img_name, hardnet_descriptor, img_data, conf_map, params_key=
         affnet_lin_maps = torch.inverse(affnet_lin_maps)
     Timer.end_check_point(init_label)
 
-    ts, phis = get_ts_phis(affnet_lin_maps)
+    ts, phis = get_ts_phis(affnet_lin_maps, device)
 
     init_label2 = Timer.start_check_point("affnet_rectify unrectified descriptions 2", tags=[AFFNET_RECTIFY_TAG])
 
@@ -839,17 +915,23 @@ def affnet_rectify(img_name, hardnet_descriptor, img_data, conf_map, params_key=
                          kpts_struct)
 
     else:
-        for current_component in img_data.valid_components_dict:
+        components_indices_t = torch.from_numpy(img_data.components_indices)
+        valid_components = list(img_data.valid_components_dict)
+        # keypoint masks of all the components at once - (#components, #kpts)
+        masks_cmp = kpts_component_indices[0] == torch.tensor(valid_components, dtype=torch.long)[:, None]
+
+        for i, current_component in enumerate(valid_components):
 
             normal_index = img_data.valid_components_dict[current_component]
             # print("processing component->normal: {} -> {}".format(current_component, normal_index))
-            mask_cmp = kpts_component_indices == current_component
+            mask_cmp = masks_cmp[i][None]
 
             add_covering_kps(t_img_all, img_data, img_name, hardnet_descriptor,
                              mask_cmp, ts, phis,
                              current_component, normal_index,
                              conf_map, params_key, stats_map,
-                             kpts_struct)
+                             kpts_struct,
+                             components_indices_t=components_indices_t)
 
     if show_affnet:
         title = "{} - all features after rectification".format(img_name)
@@ -965,20 +1047,22 @@ def decomposition_test():
         print("l: {}, psi: {}, t: {}, phi: {}".format(lambda_, psi, t, phi))
         return lambda_, psi, t, phi
 
-    projected_lin_map, lambdas, R_psis, T_ts, R_phis = compose_lin_maps(t, phi, lambdas=None, psis=None)
-    assert torch.all(projected_lin_map == lambdas * R_psis @ T_ts @ R_phis)
+    def assert_composition(lin_map, lambdas, ts, phis, psis):
+        T_ts = torch.diag_embed(torch.stack((ts, torch.ones_like(ts)), dim=-1))
+        product = lambdas[..., None, None] * get_rotation_matrices(psis) @ T_ts @ get_rotation_matrices(phis)
+        assert torch.allclose(lin_map, product, atol=1e-06)
 
-    print("decomposition scalar and matrices: lambda, R_1, T, R_2: \n {} \n {} \n {} \n {}".format(lambdas, R_psis, T_ts, R_phis))
+    projected_lin_map, lambdas = compose_lin_maps(t, phi, lambdas=None, psis=None)
+    assert_composition(projected_lin_map, lambdas, torch.atleast_2d(t), torch.atleast_2d(phi), torch.zeros((1, 1)))
     print(" = lin map: {}:".format(projected_lin_map))
 
     lambdas_back, psis_back, ts_back, phis_back = dec_and_print(projected_lin_map)
 
-    projected_lin_map_back, lambdas, R_psis, T_ts, R_phis = compose_lin_maps(ts_back, phis_back, lambdas_back, psis_back)
-    assert torch.all(projected_lin_map_back == lambdas * R_psis @ T_ts @ R_phis)
+    projected_lin_map_back, lambdas = compose_lin_maps(ts_back, phis_back, lambdas_back, psis_back)
+    assert_composition(projected_lin_map_back, lambdas, ts_back, phis_back, psis_back)
 
     assert torch.allclose(projected_lin_map_back, projected_lin_map)
 
-    print("decomposition scalar and matrices: lambda, R_1, T, R_2: \n {} \n {} \n {} \n {}".format(lambdas, R_psis, T_ts, R_phis))
     print(" = lin map: {}:".format(projected_lin_map_back))
 
     projected_lin_map_inv = torch.inverse(projected_lin_map)
@@ -159,7 +159,7 @@ class CartesianConfig:
         "num_nn": Property("int", 2, cache=Property.cache_img_data),
         "fginn_spatial_th": Property("int", 100, cache=Property.cache_img_data),
         "ratio_th": Property("float", 0.5, cache=Property.cache_img_data),
-        "feature_descriptor": Property("enum", default="SIFT", cache=Property.cache_img_data, allowed_values=["SIFT", "BRISK", "SUPERPOINT", "ROOT_SIFT", "HARD_NET"]),
+        "feature_descriptor": Property("enum", default="SIFT", cache=Property.cache_img_data, allowed_values=["SIFT", "KORNIA_SIFT", "BRISK", "SUPERPOINT", "ROOT_SIFT", "HARD_NET"]),
 
         "pipeline_final_step": Property("enum", default="final", cache=Property.all_combinations, list_allowed=False, allowed_values=["final", "before_matching", "before_rectification"]),
         "rectify_by_fixed_rotation": Property("bool", default=False, cache=Property.all_combinations),
@@ -207,6 +207,8 @@ class CartesianConfig:
         "sift_contrast_threshold": Property("float", 0.04, optional=True, cache=Property.cache_img_data), # try 0.03
         "sift_edge_threshold": Property("int", 10, optional=True, cache=Property.cache_img_data),
         "sift_sigma": Property("float", 1.6, optional=True, cache=Property.cache_img_data),
+        # ROOT_SIFT descriptors stored as uint8
+        "root_sift_uint8": Property("bool", False, optional=True, cache=Property.cache_img_data),
 
         # IMG preprocessing
         "img_read_mode": Property("enum", default=None, optional=True, list_allowed=False, allowed_values=["RGB", "GRAY"]),
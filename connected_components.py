@@ -1,6 +1,8 @@
 import math
 import numpy as np
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2 as cv
 import matplotlib.pyplot as plt
 import glob
@@ -24,9 +26,9 @@ def read_img_normals_info(parent_dir, img_name_dir):
         print(".txt or .png file doesn't exist in {}!".format(img_name_dir))
         raise
 
-    normals = np.loadtxt(paths_txt[0], delimiter=',')
-    greyscale_const = 0
-    normal_indices = cv.imread(paths_png[0], greyscale_const)
+    # explicit dtype -> numpy's C parser; ndmin=2 so that a single normal is still (1, 3)
+    normals = np.loadtxt(paths_txt[0], delimiter=',', dtype=np.float64, ndmin=2)
+    normal_indices = cv.imread(paths_png[0], cv.IMREAD_GRAYSCALE)
     return normals, normal_indices
 
 
@@ -125,9 +127,12 @@ def read_img_normals_info(parent_dir, img_name_dir):
 
 @timer_label_decorator()
 def get_and_show_components(cluster_indices, valid_component_dict, title=None, normals=None, show=True, save=False, path=None, file_name=None):
+    """
+    :return: cluster_colors(H, W, 3) - uint8; None if neither shown nor saved (nothing is computed then)
+    """
 
     if not show and not save:
-        return
+        return None
 
     colors = [
         [255, 0, 0],
@@ -154,9 +159,24 @@ def get_and_show_components(cluster_indices, valid_component_dict, title=None, n
         "navy"
     ]
 
-    cluster_colors = np.zeros((cluster_indices.shape[0], cluster_indices.shape[1], 3), dtype=np.int32)
-    for i, c_index in enumerate(valid_component_dict.keys()):
-        cluster_colors[np.where(cluster_indices == c_index)] = colors[i % 9]
+    # index -> color palette (black for the non valid indices), offset by the min. index as the indices can be negative
+    keys = list(valid_component_dict.keys())
+    min_index = min([cluster_indices.min()] + keys)
+    max_index = max([cluster_indices.max()] + keys)
+    palette = np.zeros((max_index - min_index + 1, 3), dtype=np.uint8)
+    for i, c_index in enumerate(keys):
+        palette[c_index - min_index] = colors[i % 9]
+    cluster_colors = palette[cluster_indices - min_index]
+
+    if save and not show and title is None:
+        # no figure needed (NOTE: the default title with the color legend is not rendered)
+        full_path = "{}/{}".format(path, file_name)
+        if os.path.splitext(full_path)[1] == "":
+            # as plt.savefig would do
+            full_path = "{}.png".format(full_path)
+        print("saving to {}".format(full_path))
+        cv.imwrite(full_path, cluster_colors[..., ::-1])
+        return cluster_colors
 
     # TODO clean up
     size_h = 10
@@ -169,17 +189,16 @@ def get_and_show_components(cluster_indices, valid_component_dict, title=None, n
         plt.title(title)
     # TODO this was commented out to suppress setting the title...
     else:
-        title = "{} - (connected) components: \n".format(file_name)
-        new_component_dict = {}
-        for i, c_index in enumerate(valid_component_dict.keys()):
-            new_component_dict[i] = valid_component_dict[c_index]
-        merged_dict = merge_keys_for_same_value(new_component_dict)
-        for merged_values in merged_dict:
+        # color index -> normal index
+        merged_dict = merge_keys_for_same_value(dict(enumerate(valid_component_dict.values())))
+        lines = []
+        for merged_values, normal_index in merged_dict.items():
             cur_colors_names = ", ".join([color_names[val % 9] for val in merged_values])
             if normals is not None:
-                title = "{}[{}]={}={},\n".format(title, cur_colors_names, normals[merged_dict[merged_values]], merged_dict[merged_values])
+                lines.append("[{}]={}={},\n".format(cur_colors_names, normals[normal_index], normal_index))
             else:
-                title = "{}[{}]={},\n".format(title, cur_colors_names, merged_dict[merged_values])
+                lines.append("[{}]={},\n".format(cur_colors_names, normal_index))
+        title = "{} - (connected) components: \n{}".format(file_name, "".join(lines))
 
         plt.title(title)
 
@@ -190,6 +209,7 @@ def get_and_show_components(cluster_indices, valid_component_dict, title=None, n
         plt.savefig(full_path)
 
     show_or_close(show)
+    return cluster_colors
 
 
 # def get_and_show_components_new(cluster_indices, valid_component_dict, title=None, normals=None, show=True, save=False, path=None, file_name=None, iterate_through_all=False, img=None, non_sky_mask=None):
@@ -224,28 +244,40 @@ def get_and_show_components(cluster_indices, valid_component_dict, title=None, n
 #
 #
 def circle_like_ones(size):
-    ret = np.ones((size, size), np.uint8)
     r_check = (size / 2 - 0.4) ** 2
-    for i in range(size):
-        for j in range(size):
-            r = (size / 2 - (i + 0.5)) ** 2 + (size / 2 - (j + 0.5)) ** 2
-            if r > r_check:
-                ret[i, j] = 0
-    return ret
+    centers = size / 2 - (np.arange(size) + 0.5)
+    r = centers[:, None] ** 2 + centers[None, :] ** 2
+    return (r <= r_check).astype(np.uint8)
+
+
+# flood_fill's mask value -> 1 if not filled (the mask is 0 there), 0 otherwise
+FLOOD_FILL_NOT_FILLED_LUT = np.zeros(256, np.uint8)
+FLOOD_FILL_NOT_FILLED_LUT[0] = 1
+
+# reused by flood_fill (per thread), reallocated when the image size changes
+flood_fill_buffers = threading.local()
 
 
 def flood_fill(input_img):
 
-    flood_filled = input_img.copy()
-    flood_filled[0, :] = 0
-    flood_filled[flood_filled.shape[0] - 1, :] = 0
-    flood_filled[:, flood_filled.shape[1] - 1] = 0
-    flood_filled[:, 0] = 0
+    flood_fill_img_buffer = getattr(flood_fill_buffers, "img", None)
+    if flood_fill_img_buffer is None or flood_fill_img_buffer.shape != input_img.shape:
+        flood_fill_buffers.img = np.empty(input_img.shape, np.uint8)
+        flood_fill_buffers.mask = np.empty((input_img.shape[0] + 2, input_img.shape[1] + 2), np.uint8)
+    flood_fill_img_buffer = flood_fill_buffers.img
+    flood_fill_mask_buffer = flood_fill_buffers.mask
+
+    # the input with zeroed borders (the seed region)
+    np.copyto(flood_fill_img_buffer, input_img)
+    flood_fill_img_buffer[[0, -1]] = 0
+    flood_fill_img_buffer[:, [0, -1]] = 0
 
-    mask = np.zeros((flood_filled.shape[0] + 2, flood_filled.shape[1] + 2), np.uint8)
-    cv.floodFill(flood_filled, mask, (0, 0), 2)
-    flood_filled = np.where(flood_filled == 2, 0, 1).astype(dtype=np.uint8)
-    flood_filled = flood_filled | input_img
+    flood_fill_mask_buffer.fill(0)
+    # fills only the mask (with 1) - the image buffer itself is left untouched
+    cv.floodFill(flood_fill_img_buffer, flood_fill_mask_buffer, (0, 0), 0, flags=4 | cv.FLOODFILL_MASK_ONLY | cv.FLOODFILL_FIXED_RANGE | (1 << 8))
+
+    flood_filled = FLOOD_FILL_NOT_FILLED_LUT[flood_fill_mask_buffer[1:-1, 1:-1]]
+    np.bitwise_or(flood_filled, input_img, out=flood_filled)
     return flood_filled
 
 
@@ -259,33 +291,82 @@ def get_connected_components(normal_indices, valid_indices, show=False,
     out_valid_indices_dict = {}
     out_valid_indices_counter = 0
 
-    for v_i in valid_indices:
-        input = np.where(normal_indices == v_i, 1, 0).astype(dtype=np.uint8)
+    if closing_size is not None:
+        kernel = circle_like_ones(size=closing_size) # np.ones((closing_size, closing_size) np.uint8)
+
+    # prune the normals with too few pixels (closing and flood filling can only add pixels, so only the empty ones then)
+    valid_indices = list(valid_indices)
+    if len(valid_indices) > 0 and np.issubdtype(normal_indices.dtype, np.integer) and normal_indices.min() >= 0:
+        pixel_counts = np.bincount(normal_indices.ravel(), minlength=max(valid_indices) + 1)
+        grows = closing_size is not None or flood_filling
+        min_count = 0 if grows else component_size_threshold
+        valid_indices = [v_i for v_i in valid_indices if pixel_counts[v_i] > min_count]
+
+    # there are at most H * W / 2 (+ background) components, CV_16U halves the labels' memory traffic if that fits
+    labels_type = cv.CV_16U if normal_indices.size // 2 + 2 <= np.iinfo(np.uint16).max else cv.CV_32S
+
+    def label_normal(v_i):
+        """
+        :param v_i: normal index (from valid_indices)
+        :return: labels_count, labels, counts, stats - or None if there can't be any valid component
+        """
+        # the binary mask is built here (i.e. just one (H, W) mask per worker at a time), viewed as uint8 for OpenCV
+        input = np.equal(normal_indices, v_i).view(np.uint8)
+
+        # degenerate masks - no need for the closing / flood filling / labeling
+        non_zero = cv.countNonZero(input)
+        if non_zero == 0 or (non_zero <= component_size_threshold and closing_size is None and not flood_filling):
+            return None
+        if non_zero == input.size:
+            # a single component over the whole image
+            stats = np.array([[0, 0, 0, 0, 0], [0, 0, input.shape[1], input.shape[0], non_zero]])
+            return 2, np.broadcast_to(np.uint8(1), input.shape), stats[:, cv.CC_STAT_AREA], stats
 
         if closing_size is not None:
-            kernel = circle_like_ones(size=closing_size) # np.ones((closing_size, closing_size) np.uint8)
             input = cv.morphologyEx(input, cv.MORPH_CLOSE, kernel)
 
         if flood_filling:
             input = flood_fill(input)
 
-        _, labels = cv.connectedComponents(input, connectivity=connectivity)
+        labels_count, labels, stats, _ = cv.connectedComponentsWithStats(input, connectivity=connectivity, ltype=labels_type)
+        return labels_count, labels, stats[:, cv.CC_STAT_AREA], stats
+
+    if len(valid_indices) > 1:
+        # the normals are independent (and OpenCV releases the GIL), only the merge into out below is sequential
+        with ThreadPoolExecutor(max_workers=min(len(valid_indices), os.cpu_count() or 1)) as executor:
+            results = list(executor.map(label_normal, valid_indices))
+    else:
+        results = map(label_normal, valid_indices)
+
+    for v_i, result in zip(valid_indices, results):
+        if result is None:
+            continue
+        labels_count, labels, counts, stats = result
 
-        unique, counts = np.unique(labels, return_counts=True)
-        valid_labels = np.where(counts > component_size_threshold)[0]
+        valid_labels = np.nonzero(counts > component_size_threshold)[0]
         # Docs: RETURNS: The sorted unique values. - see https://numpy.org/doc/stable/reference/generated/numpy.unique.html
         if valid_labels[0] == 0:
             valid_labels = valid_labels[1:]
         if len(valid_labels) != 0:
-            max_valid_labels = np.max(valid_labels)
-            valid_labels = valid_labels + out_valid_indices_counter
-            labels = labels + out_valid_indices_counter
-
-            for v_i_i in valid_labels:
-                out = np.where(labels == v_i_i, labels, out)
-
-            out_valid_indices_dict.update({v_i_i: v_i for v_i_i in valid_labels})
-            out_valid_indices_counter = out_valid_indices_counter + max_valid_labels
+            # only the bounding box of the valid components needs to be remapped
+            valid_stats = stats[valid_labels]
+            top = valid_stats[:, cv.CC_STAT_TOP].min()
+            bottom = (valid_stats[:, cv.CC_STAT_TOP] + valid_stats[:, cv.CC_STAT_HEIGHT]).max()
+            left = valid_stats[:, cv.CC_STAT_LEFT].min()
+            right = (valid_stats[:, cv.CC_STAT_LEFT] + valid_stats[:, cv.CC_STAT_WIDTH]).max()
+            roi = (slice(top, bottom), slice(left, right))
+
+            # valid labels are compacted into consecutive new ids
+            new_ids = np.arange(len(valid_labels)) + (out_valid_indices_counter + 1)
+
+            # label -> new id (0 for the invalid labels), i.e. a single pass over labels
+            lut = np.zeros(labels_count, dtype=np.int32)
+            lut[valid_labels] = new_ids
+            new_labels = lut[labels[roi]]
+            np.copyto(out[roi], new_labels, where=new_labels != 0)
+
+            out_valid_indices_dict.update(dict.fromkeys(new_ids.tolist(), v_i))
+            out_valid_indices_counter = out_valid_indices_counter + len(valid_labels)
 
         if show:
             # NOTE not very revealing btw.
@@ -299,8 +380,9 @@ def find_and_show_clusters(parent_dir, limit, interesting_dirs=None):
     if interesting_dirs is not None:
         dirs = interesting_dirs
     else:
-        dirs = [dirname for dirname in sorted(os.listdir(parent_dir)) if os.path.isdir("{}/{}".format(parent_dir, dirname))]
-        dirs = sorted(dirs)
+        # DirEntry.is_dir() doesn't need an extra stat call (on most platforms)
+        with os.scandir(parent_dir) as entries:
+            dirs = sorted(entry.name for entry in entries if entry.is_dir())
         if limit is not None:
             dirs = dirs[0:limit]
 
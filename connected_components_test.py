@@ -0,0 +1,27 @@
+import numpy as np
+
+from connected_components import get_connected_components
+
+
+def test_get_connected_components_whole_image():
+    # a single normal over the whole image is a single (valid) component
+    normal_indices = np.zeros((40, 50), dtype=np.uint8)
+
+    components_indices, valid_components_dict = get_connected_components(normal_indices, [0])
+
+    assert valid_components_dict == {1: 0}
+    assert np.all(components_indices == 1)
+
+
+def test_get_connected_components():
+    normal_indices = np.zeros((40, 50), dtype=np.uint8)
+    normal_indices[:, 25:] = 1
+    # too small (< 3% of the pixels)
+    normal_indices[:5, :5] = 2
+
+    components_indices, valid_components_dict = get_connected_components(normal_indices, [0, 1, 2])
+
+    assert valid_components_dict == {1: 0, 2: 1}
+    assert np.all(components_indices[5:, :25] == 1)
+    assert np.all(components_indices[:, 25:] == 2)
+    assert np.all(components_indices[:5, :5] == 0)
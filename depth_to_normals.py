@@ -77,7 +77,7 @@ def get_rotation_matrices_across_img(camera: CameraEntry, depth_data: np.ndarray
     K[0] = K[0] * down_sample_factor_x
     K[1] = K[1] * down_sample_factor_y
 
-    Q_inv = np.linalg.inv(K)
+    Q_inv = get_K_inv(K)
 
     height = depth_data.shape[2]
     width = depth_data.shape[3]
@@ -299,10 +299,11 @@ def compute_normals(scene: SceneInfo,
     :return: (normals, normal_indices)
     """
 
-    if True:
-        raise Exception("not implemented - need 'img_name' as a parameter as in 'K = scene.get_img_K(img_name)'")
-
-    K = scene.get_img_K("img_name")
+    # the img is read (and decoded) just once - for K, its size and the sky mask
+    img_name = depth_data_file_name[0:-4]
+    img_file_path = scene.get_img_file_path(img_name)
+    img = cv.imread(img_file_path, cv.IMREAD_COLOR)
+    K = scene.get_img_K(img_name, img)
 
     focal_length = K[0, 0]
     orig_height = img.shape[0]
@@ -314,9 +315,6 @@ def compute_normals(scene: SceneInfo,
                                    depth_data_read_directory,
                                    depth_data_file_name)
 
-    img_name = depth_data_file_name[0:-4]
-    img_file_path = scene.get_img_file_path(img_name)
-    img = cv.imread(img_file_path)
     filter_mask = get_nonsky_mask(img, normals.shape[0], normals.shape[1])
     show_sky_mask(img, filter_mask, img_name, show=True)
 
@@ -352,6 +350,25 @@ def compute_normals_convolution(camera,
     return normals
 
 
+# torch.linalg.svd has the 'driver' kwarg only since torch 1.13 (the pinned torch 1.10 raises TypeError on it)
+SVD_DRIVER_SUPPORTED = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (1, 13)
+
+
+@timer_label_decorator()
+def svd_batched(data):
+    """
+    torch.svd replacement for large batches of tiny matrices - on CUDA the batched Jacobi (gesvdj) driver is used
+    if the installed torch supports it
+    :param data: torch.Tensor(B, M, N)
+    :return: U, s, V (as returned by torch.svd, i.e. data = U @ diag(s) @ V^T)
+    """
+    if data.is_cuda and SVD_DRIVER_SUPPORTED:
+        U, s, Vh = torch.linalg.svd(data, full_matrices=False, driver='gesvdj')
+    else:
+        U, s, Vh = torch.linalg.svd(data, full_matrices=False)
+    return U, s, Vh.transpose(-2, -1)
+
+
 @timer_label_decorator()
 def compute_normals_from_svd(
         focal_length,
@@ -445,9 +462,9 @@ def compute_normals_from_svd(
         else:
             c2 = centered.transpose(-2, -1) @ w_diag @ centered
 
-        U, s_values, V = torch.svd(c2)
+        U, s_values, V = svd_batched(c2)
     else:
-        U, s_values, V = torch.svd(centered)
+        U, s_values, V = svd_batched(centered)
 
     normals = V[:, :, 2]
     normals = normals.reshape(new_depth_height, new_depth_width, 3)
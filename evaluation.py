@@ -1,7 +1,11 @@
 import argparse
+import dataclasses
+import heapq
+import json
 import pickle
 import sys
 import traceback
+import zipfile
 from typing import List
 
 import torch
@@ -24,9 +28,18 @@ def normalize_keypoints(keypoints, K):
     C_y = K[1, 2]
     f_x = K[0, 0]
     f_y = K[1, 1]
-    keypoints = (keypoints - np.array([[C_x, C_y]])) / np.array([[f_x, f_y]])
+    normalized = np.empty(keypoints.shape, dtype=np.float64)
+    np.subtract(keypoints[:, 0], C_x, out=normalized[:, 0])
+    normalized[:, 0] /= f_x
+    np.subtract(keypoints[:, 1], C_y, out=normalized[:, 1])
+    normalized[:, 1] /= f_y
 
-    return keypoints
+    return normalized
+
+
+IDENTITY_3 = np.eye(3)
+# |R @ R.T - I| up to which the closed form is used in quaternion_from_matrix (the quaternions then differ by O(tol))
+ROTATION_ORTHONORMALITY_TOL = 1e-6
 
 
 def quaternion_from_matrix(matrix, isprecise=False):
@@ -95,6 +108,27 @@ def quaternion_from_matrix(matrix, isprecise=False):
         m21 = M[2, 1]
         m22 = M[2, 2]
 
+        R = M[:3, :3]
+        if np.abs(R @ R.T - IDENTITY_3).max() <= ROTATION_ORTHONORMALITY_TOL:
+            # (numerically) a rotation: closed form (Shepperd), no need for the eigen-decomposition
+            t = m00 + m11 + m22
+            if t > 0.0:
+                s = 2.0 * math.sqrt(t + 1.0)
+                q = np.array([0.25 * s, (m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s])
+            elif m00 > m11 and m00 > m22:
+                s = 2.0 * math.sqrt(1.0 + m00 - m11 - m22)
+                q = np.array([(m21 - m12) / s, 0.25 * s, (m01 + m10) / s, (m02 + m20) / s])
+            elif m11 > m22:
+                s = 2.0 * math.sqrt(1.0 + m11 - m00 - m22)
+                q = np.array([(m02 - m20) / s, (m01 + m10) / s, 0.25 * s, (m12 + m21) / s])
+            else:
+                s = 2.0 * math.sqrt(1.0 + m22 - m00 - m11)
+                q = np.array([(m10 - m01) / s, (m02 + m20) / s, (m12 + m21) / s, 0.25 * s])
+            q /= np.linalg.norm(q)
+            if q[0] < 0.0:
+                np.negative(q, q)
+            return q
+
         # symmetric matrix K
         K = np.array([[m00 - m11 - m22, 0.0, 0.0, 0.0],
                       [m01 + m10, m11 - m00 - m22, 0.0, 0.0],
@@ -160,7 +194,7 @@ def eval_essential_matrix(p1n, p2n, E, dR, dt):
         raise RuntimeError('Size mismatch in the keypoint lists')
 
     if p1n.shape[0] < 5:
-        return np.pi, np.pi / 2
+        return np.pi, np.pi / 2, None
 
     if E.size > 0:
         _, R, t, _ = cv.recoverPose(E, p1n, p2n)
@@ -169,6 +203,7 @@ def eval_essential_matrix(p1n, p2n, E, dR, dt):
     else:
         err_q = np.pi
         err_t = np.pi / 2
+        R = None
 
     return err_q, err_t, R
 
@@ -195,36 +230,35 @@ def compare_R_to_GT(img_pair: ImagePairEntry, scene_info: SceneInfo, r):
     return err_q
 
 
-def compare_poses(E, img_pair: ImagePairEntry, scene_info: SceneInfo, pts1, pts2, img_data_list):
+def get_compare_poses_args(E, img_pair: ImagePairEntry, scene_info: SceneInfo, pts1, pts2, img_data_list):
+    """
+    :return: (p1n, p2n, E, dR, dt) - the arguments for eval_essential_matrix
+    """
 
-    img_entry_1: ImageEntry = scene_info.img_info_map[img_pair.img1]
-    T1 = img_entry_1.t
-    R1 = img_entry_1.R
-
-    img_entry_2: ImageEntry = scene_info.img_info_map[img_pair.img2]
-    T2 = img_entry_2.t
-    R2 = img_entry_2.R
-
-    dR = R2 @ R1.T
-    dt = T2 - dR @ T1
+    dR, dt = get_GT_R_t(img_pair, scene_info)
 
     K1 = scene_info.get_img_K(img_pair.img1, img_data_list[0].img)
     K2 = scene_info.get_img_K(img_pair.img2, img_data_list[1].img)
 
     # TODO Q: what is actually this? if I remove it, I can remove the call to scene_info.get_img_K
-    p1n = normalize_keypoints(pts1, K1).astype(np.float64)
-    p2n = normalize_keypoints(pts2, K2).astype(np.float64)
+    p1n = normalize_keypoints(pts1, K1)
+    p2n = normalize_keypoints(pts2, K2)
     # Q: this doesn't change the result!!!
     # p1n = pts1
     # p2n = pts2
 
-    err_q, err_t, dr_est = eval_essential_matrix(p1n, p2n, E, dR, dt)
+    return p1n, p2n, E, dR, dt
+
+
+def compare_poses(E, img_pair: ImagePairEntry, scene_info: SceneInfo, pts1, pts2, img_data_list):
+
+    p1n, p2n, E, dR, dt = get_compare_poses_args(E, img_pair, scene_info, pts1, pts2, img_data_list)
 
-    rot_vec_deg_est = get_rot_vec_deg(dr_est)
-    rot_vec_deg_gt = get_rot_vec_deg(dR)
+    err_q, err_t, dr_est = eval_essential_matrix(p1n, p2n, E, dR, dt)
 
-    print("rotation vector(GT): {}".format(rot_vec_deg_gt))
-    print("rotation vector(est): {}".format(rot_vec_deg_est))
+    print("rotation vector(GT): {}".format(get_rot_vec_deg(dR)))
+    if dr_est is not None:
+        print("rotation vector(est): {}".format(get_rot_vec_deg(dr_est)))
     print("errors (R, T): ({} degrees, {} (unscaled))".format(np.rad2deg(err_q), err_t))
 
     return err_q, err_t
@@ -244,8 +278,24 @@ def _pickle_keypoints(point):
 copyreg.pickle(cv2.KeyPoint().__class__, _pickle_keypoints)
 
 
+def set_slots_state(obj, state):
+    """
+    __setstate__ for the slotted dataclasses below - handles both the slots state and the __dict__ state
+    of the legacy pickles; attributes that are not slots (anymore) are dropped, missing ones are set to None
+    :param obj:
+    :param state: dict or (dict, dict) as produced by pickle
+    """
+    if isinstance(state, tuple):
+        state = {**(state[0] or {}), **(state[1] or {})}
+    for name in obj.__slots__:
+        setattr(obj, name, state.get(name))
+
+
 @dataclass
 class ImageData:
+    __slots__ = ("img", "key_points", "descriptions", "real_K", "normals", "ts_phis", "components_indices",
+                 "valid_components_dict", "key_points_xy_cache")
+
     img: np.ndarray
     key_points: List[cv.KeyPoint]
     descriptions: object
@@ -266,6 +316,25 @@ class ImageData:
                          components_indices=img_serialized_data.components_indices,
                          valid_components_dict=img_serialized_data.valid_components_dict)
 
+    def __setattr__(self, name, value):
+        # the coordinates cached by get_key_points_xy are cleared whenever key_points is assigned
+        if name == "key_points":
+            object.__setattr__(self, "key_points_xy_cache", None)
+        object.__setattr__(self, name, value)
+
+    def get_key_points_xy(self):
+        """
+        NOTE the cache is cleared when key_points is assigned, but not when the list is modified in place
+        :return: np.ndarray(N, 2) of the key points' coordinates (see kps_to_xy) - cached until key_points is reassigned
+        """
+        if self.key_points_xy_cache is None:
+            self.key_points_xy_cache = kps_to_xy(self.key_points)
+        return self.key_points_xy_cache
+
+    def __setstate__(self, state):
+        set_slots_state(self, state)
+        self.key_points_xy_cache = None
+
     def to_serialized_data(self):
         return ImageSerializedData(kpts=self.key_points,
                                    descs=self.descriptions,
@@ -276,15 +345,22 @@ class ImageData:
 
 @dataclass
 class ImageSerializedData:
+    __slots__ = ("kpts", "descs", "normals", "components_indices", "valid_components_dict")
+
     kpts: list
     descs: list
     normals: np.ndarray
     components_indices: np.ndarray
     valid_components_dict: dict
 
+    def __setstate__(self, state):
+        set_slots_state(self, state)
+
 
 @dataclass
 class Stats:
+    __slots__ = ("inliers_against_gt", "tentatives_1", "tentatives_2", "error_R", "error_T", "tentative_matches",
+                 "inliers", "all_features_1", "all_features_2", "E", "normals1", "normals2")
 
     inliers_against_gt: (int, int, int)
     tentatives_1: (float, float)
@@ -299,14 +375,65 @@ class Stats:
     normals1: np.ndarray
     normals2: np.ndarray
 
-    # legacy
-    def make_brief(self):
-        self.src_pts_inliers = None
-        self.dst_pts_inliers = None
-        self.src_tentatives = None
-        self.dst_tentatives = None
-        self.kpts1 = None
-        self.kpts2 = None
+    # NOTE the legacy attributes (src_pts_inliers, dst_pts_inliers, src_tentatives, dst_tentatives, kpts1, kpts2)
+    # that make_brief used to clear are dropped on unpickling
+    def __setstate__(self, state):
+        set_slots_state(self, state)
+
+
+STATS_MAP_SCALARS_KEY = "scalars"
+
+
+def save_stats_map(stats_map, file_name):
+    """
+    Saves {key: Stats} as a single compressed npz - the ndarray fields go as separate arrays
+    ("<index>/<field>"), the rest together with the keys as a json string
+    :param stats_map: {key: Stats}
+    :param file_name: written as is (no .npz suffix is appended)
+    """
+    arrays = {}
+    scalars = []
+    for i, (key, stats) in enumerate(stats_map.items()):
+        stats_scalars = {}
+        for field in dataclasses.fields(Stats):
+            value = getattr(stats, field.name, None)
+            if isinstance(value, np.ndarray):
+                arrays["{}/{}".format(i, field.name)] = value
+            elif value is not None:
+                stats_scalars[field.name] = value.item() if isinstance(value, np.generic) else value
+        scalars.append((key, stats_scalars))
+    arrays[STATS_MAP_SCALARS_KEY] = np.array(json.dumps(scalars))
+
+    # a file object so that np.savez_compressed doesn't append the suffix
+    with open(file_name, "wb") as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_stats_map(file_name):
+    """
+    Reads the stats map saved by save_stats_map, falls back to pickle for the legacy files
+    :param file_name:
+    :return: {key: Stats}
+    """
+    if not zipfile.is_zipfile(file_name):
+        with open(file_name, "rb") as f:
+            return pickle.load(f)
+
+    stats_map = {}
+    with np.load(file_name, allow_pickle=False) as data:
+        scalars = json.loads(data[STATS_MAP_SCALARS_KEY].item())
+        for i, (key, stats_scalars) in enumerate(scalars):
+            values = {}
+            for field in dataclasses.fields(Stats):
+                array_key = "{}/{}".format(i, field.name)
+                if array_key in data:
+                    values[field.name] = data[array_key]
+                else:
+                    value = stats_scalars.get(field.name)
+                    # json has no tuples
+                    values[field.name] = tuple(value) if isinstance(value, list) else value
+            stats_map[key] = Stats(**values)
+    return stats_map
 
 
 COMPLETE_IMAGE_PAIR_MATCHING_TAG = "complete_image_pair_matching"
@@ -323,16 +450,18 @@ def evaluate_matching(scene_info,
                       ransac_th,
                       ):
 
+    inliers_mask_1d = inlier_mask[:, 0] == 1
+    inliers = int(np.count_nonzero(inliers_mask_1d))
+
     print("Image pair: {} <-> {}:".format(img_pair.img1, img_pair.img2))
-    print("Number of inliers: {}".format(inlier_mask[inlier_mask == [1]].shape[0]))
-    print("Number of outliers: {}".format(inlier_mask[inlier_mask == [0]].shape[0]))
+    print("Number of inliers: {}".format(inliers))
+    print("Number of outliers: {}".format(inlier_mask.shape[0] - inliers))
 
-    src_tentatives_2d, dst_tentatives_2d = split_points(tentative_matches, img_data_list[0].key_points, img_data_list[1].key_points)
-    src_pts_inliers = src_tentatives_2d[inlier_mask[:, 0] == [1]]
-    dst_pts_inliers = dst_tentatives_2d[inlier_mask[:, 0] == [1]]
+    src_tentatives_2d, dst_tentatives_2d = split_points(tentative_matches, img_data_list[0].get_key_points_xy(), img_data_list[1].get_key_points_xy())
+    src_pts_inliers = src_tentatives_2d[inliers_mask_1d]
+    dst_pts_inliers = dst_tentatives_2d[inliers_mask_1d]
 
     error_R, error_T = compare_poses(E, img_pair, scene_info, src_pts_inliers, dst_pts_inliers, img_data_list)
-    inliers = np.sum(np.where(inlier_mask[:, 0] == [1], 1, 0))
 
     if is_rectified_condition(img_data_list[0]):
         _, unique, counts = get_normals_stats(img_data_list, src_tentatives_2d, dst_tentatives_2d)
@@ -412,13 +541,16 @@ def read_last():
     gl.sort()
     last_file = "{}/{}".format(gl[-1], "all.stats.pkl")
 
-    with open(last_file, "rb") as f:
-        print("reading: {}".format(last_file))
-        stats_map_read = pickle.load(f)
+    print("reading: {}".format(last_file))
+    stats_map_read = load_stats_map(last_file)
 
     return stats_map_read
 
 
+# (matches chunk x GT points) float64 elements per get_kps_gt_id step - bounds the memory of the distance temporaries
+KPS_GT_ID_CHUNK_ELEMENTS = 2 ** 20
+
+
 def get_kps_gt_id(kps_matches_np, image_entry: ImageEntry, diff_threshold=2.0):
 
     # kps_matches_points = [list(kps[kps_index].pt) for kps_index in kps_indices]
@@ -427,20 +559,22 @@ def get_kps_gt_id(kps_matches_np, image_entry: ImageEntry, diff_threshold=2.0):
     image_data = image_entry.data
     data_ids = image_entry.data_point_idxs
 
-    diff = np.ndarray(image_data.shape)
-    mins = np.ndarray(kps_matches_np.shape[0])
+    # (chunk, N) squared distances at a time to bound the memory
+    chunk_size = max(1, KPS_GT_ID_CHUNK_ELEMENTS // max(1, image_data.shape[0]))
+    min_indices = np.empty(kps_matches_np.shape[0], dtype=np.int64)
+    mins = np.empty(kps_matches_np.shape[0])
+    for start in range(0, kps_matches_np.shape[0], chunk_size):
+        match_points = kps_matches_np[start:start + chunk_size]
+        diff_x = (image_data[None, :, 0] - match_points[:, None, 0]).astype(np.float64)
+        diff_y = (image_data[None, :, 1] - match_points[:, None, 1]).astype(np.float64)
+        dist2 = diff_x * diff_x + diff_y * diff_y
+        chunk_min_indices = np.argmin(dist2, axis=1)
+        min_indices[start:start + chunk_size] = chunk_min_indices
+        mins[start:start + chunk_size] = np.sqrt(dist2[np.arange(len(match_points)), chunk_min_indices])
+
     data_point_ids = -2 * np.ones(kps_matches_np.shape[0], dtype=np.int32)
-    for p_idx, match_point in enumerate(kps_matches_np):
-        diff[:, 0] = image_data[:, 0] - match_point[0]
-        diff[:, 1] = image_data[:, 1] - match_point[1]
-        diff_norm = np.linalg.norm(diff, axis=1)
-        min_index = np.argmin(diff_norm)
-        min_diff = diff_norm[min_index]
-        mins[p_idx] = min_diff
-        if min_diff < diff_threshold:
-            data_point_ids[p_idx] = data_ids[min_index]
-        # else:
-        #     print()
+    close = mins < diff_threshold
+    data_point_ids[close] = data_ids[min_indices[close]]
 
     return data_point_ids, mins
 
@@ -464,12 +598,37 @@ def print_stats(stat_name: str, stat_in_list: list):
     print("average {}: {}".format(stat_name, np.sum(np_ar) / len(stat_in_list)))
 
 
-def vector_product_matrix(vec: np.ndarray):
-    return np.array([
-        [    0.0, -vec[2],  vec[1]],
-        [ vec[2],     0.0, -vec[0]],
-        [-vec[1],  vec[0],     0.0],
-    ])
+def epipolar_distances(pts1, pts2, F, eps=1e-8):
+    """
+    Squared sampson and symmetrical epipolar distances (as in kornia.geometry.epipolar) sharing the epipolar lines
+    :param pts1: np.ndarray(N, 2)
+    :param pts2: np.ndarray(N, 2)
+    :param F: np.ndarray(3, 3)
+    :param eps: as in kornia.geometry.epipolar.symmetrical_epipolar_distance
+    :return: sampson(N), symmetrical(N)
+    """
+
+    x1 = pts1[:, 0].astype(np.float64)
+    y1 = pts1[:, 1].astype(np.float64)
+    x2 = pts2[:, 0].astype(np.float64)
+    y2 = pts2[:, 1].astype(np.float64)
+
+    # F @ x1 and (F.T @ x2)[:2]
+    Fx0 = F[0, 0] * x1 + F[0, 1] * y1 + F[0, 2]
+    Fx1 = F[1, 0] * x1 + F[1, 1] * y1 + F[1, 2]
+    Fx2 = F[2, 0] * x1 + F[2, 1] * y1 + F[2, 2]
+    Ftx0 = F[0, 0] * x2 + F[1, 0] * y2 + F[2, 0]
+    Ftx1 = F[0, 1] * x2 + F[1, 1] * y2 + F[2, 1]
+
+    # (x2^T F x1)^2 and the squared magnitudes |(F x1)[:2]|^2, |(F^T x2)[:2]|^2 (H&Z (11.9)) - written out per
+    # component as it is ~2x faster than building the homogeneous points and using @ / np.einsum
+    numerator = (x2 * Fx0 + y2 * Fx1 + Fx2) ** 2
+    norm1 = Fx0 * Fx0 + Fx1 * Fx1
+    norm2 = Ftx0 * Ftx0 + Ftx1 * Ftx1
+
+    sampson = numerator / (norm1 + norm2)
+    symmetrical = numerator * (1.0 / (norm1 + eps) + 1.0 / (norm2 + eps))
+    return sampson, symmetrical
 
 
 def evaluate_tentatives_agains_ground_truth(scene_info: SceneInfo,
@@ -481,59 +640,33 @@ def evaluate_tentatives_agains_ground_truth(scene_info: SceneInfo,
                                             est_E,
                                             inliers_from_ransac):
 
-    def get_T_R_K_inv(img_key, img):
-        img_entry: ImageEntry = scene_info.img_info_map[img_key]
-        T = np.array(img_entry.t)
-        R = img_entry.R
-        # TODO we use the real K here, right?
-        K = scene_info.get_img_K(img_key, img)
-        K_inv = np.linalg.inv(K)
-        return T, R, K_inv, K
+    # TODO we use the real K here, right?
+    K1_inv = scene_info.get_img_K_inv(img_pair.img1, img_data_list[0].img)
+    K2_inv = scene_info.get_img_K_inv(img_pair.img2, img_data_list[1].img)
 
-    T1, R1, K1_inv, K1 = get_T_R_K_inv(img_pair.img1, img_data_list[0].img)
-    src_tentative_h = np.ndarray((src_tentatives_2d.shape[0], 3))
-    src_tentative_h[:, :2] = src_tentatives_2d
-    src_tentative_h[:, 2] = 1.0
+    F_ground_truth = scene_info.get_F_ground_truth(img_pair.img1, img_data_list[0].img, img_pair.img2, img_data_list[1].img)
+    sampson_gt, symmetrical_gt = epipolar_distances(src_tentatives_2d, dst_tentatives_2d, F_ground_truth)
 
-    T2, R2, K2_inv, K2 = get_T_R_K_inv(img_pair.img2, img_data_list[1].img)
-    dst_tentative_h = np.ndarray((dst_tentatives_2d.shape[0], 3))
-    dst_tentative_h[:, :2] = dst_tentatives_2d
-    dst_tentative_h[:, 2] = 1.0
+    # as KG.fundamental_from_essential, without the torch round trip
+    computed_F = K2_inv.T @ est_E @ K1_inv
+    sampson_estimated, symmetrical_estimated = epipolar_distances(src_tentatives_2d, dst_tentatives_2d, computed_F)
 
-    F_ground_truth = K2_inv.T @ R2 @ vector_product_matrix(T2 - T1) @ R1.T @ K1_inv
-    F_ground_truth = torch.from_numpy(F_ground_truth).unsqueeze(0)
-
-    src_pts_torch = torch.from_numpy(src_tentatives_2d).type(torch.DoubleTensor)
-    dst_pts_torch = torch.from_numpy(dst_tentatives_2d).type(torch.DoubleTensor)
-
-    kornia_sampson_gt = KG.epipolar.sampson_epipolar_distance(src_pts_torch, dst_pts_torch, F_ground_truth).numpy()
-    kornia_symmetrical_gt = KG.epipolar.symmetrical_epipolar_distance(src_pts_torch, dst_pts_torch, F_ground_truth).numpy()
-
-    computed_F = KG.fundamental_from_essential(torch.from_numpy(est_E), torch.from_numpy(K1), torch.from_numpy(K2))
-    computed_F = computed_F.unsqueeze(0)
-
-    kornia_sampson_estimated = KG.epipolar.sampson_epipolar_distance(src_pts_torch, dst_pts_torch, computed_F).numpy()
-    kornia_symmetrical_estimated = KG.epipolar.symmetrical_epipolar_distance(src_pts_torch, dst_pts_torch, computed_F).numpy()
-
-    count_sampson_gt = np.zeros(len(thresholds), dtype=int)
-    count_symmetrical_gt = np.zeros(len(thresholds), dtype=int)
-    count_sampson_estimated = np.zeros(len(thresholds), dtype=int)
-    count_symmetrical_estimated = np.zeros(len(thresholds), dtype=int)
+    abs_metrics = [np.abs(sampson_gt), np.abs(symmetrical_gt), np.abs(sampson_estimated), np.abs(symmetrical_estimated)]
 
     print("Matching stats in inliers:")
-    def evaluate_metric(metric, th, label):
-        mask = (np.abs(metric) < th)[0]
-        if is_rectified_condition(img_data_list[0]):
-            _, unique, counts = get_normals_stats(img_data_list, src_tentatives_2d, dst_tentatives_2d, mask)
-            print("{} < {}:".format(label, th))
-            print("unique plane correspondence counts:\n{}".format(np.vstack((unique.T, counts)).T))
-        return np.sum(mask)
-
-    for i in range(len(thresholds)):
-        count_sampson_gt[i] = evaluate_metric(kornia_sampson_gt, thresholds[i], "sampson gt")
-        count_symmetrical_gt[i] = evaluate_metric(kornia_symmetrical_gt, thresholds[i], "symmetrical gt")
-        count_sampson_estimated[i] = evaluate_metric(kornia_sampson_estimated, thresholds[i], "sampson estimated")
-        count_symmetrical_estimated[i] = evaluate_metric(kornia_symmetrical_estimated, thresholds[i], "symmetrical estimated")
+    if is_rectified_condition(img_data_list[0]):
+        labels = ["sampson gt", "symmetrical gt", "sampson estimated", "symmetrical estimated"]
+        for th in thresholds:
+            for abs_metric, label in zip(abs_metrics, labels):
+                _, unique, counts = get_normals_stats(img_data_list, src_tentatives_2d, dst_tentatives_2d, abs_metric < th)
+                print("{} < {}:".format(label, th))
+                print("unique plane correspondence counts:\n{}".format(np.vstack((unique.T, counts)).T))
+
+    # one sort and a binary search per threshold instead of a full scan per threshold
+    count_sampson_gt, \
+    count_symmetrical_gt, \
+    count_sampson_estimated, \
+    count_symmetrical_estimated = [np.searchsorted(np.sort(abs_metric), thresholds, side="left") for abs_metric in abs_metrics]
 
     print("inliers from ransac: {}".format(inliers_from_ransac))
     print("thresholds for inliers: {}".format(thresholds))
@@ -707,12 +840,15 @@ def evaluate_all_matching_stats(stats_map_all: dict, tex_save_path_prefix=None,
 
 def print_significant_instances(stats_map, difficulty, key, n_examples=10):
 
-    sorted_by_err_R = list(sorted(stats_map.items(), key=lambda key_value: -key_value[1].error_R))
+    # only the k extremes are printed, no need to sort the whole map
+    def err_R(key_value):
+        return key_value[1].error_R
+
     print("{} worst examples for {} for diff={}".format(n_examples, key, difficulty))
-    for k, v in sorted_by_err_R[:n_examples]:
+    for k, v in heapq.nlargest(n_examples, stats_map.items(), key=err_R):
         print("{}: {}".format(k, v.error_R))
     print("{} best examples for {} for diff={}".format(n_examples, key, difficulty))
-    for k, v in sorted_by_err_R[-n_examples:]:
+    for k, v in heapq.nsmallest(n_examples, stats_map.items(), key=err_R)[::-1]:
         print("{}: {}".format(k, v.error_R))
 
 
@@ -756,7 +892,9 @@ def compare_stats_maps(stats_map1: dict, stats_map2: dict, difficulty, n_worst_e
     perc2 = len(keys2) / len(stats_map2)
 
     stats = [(key, stats_map1[key], stats_map2[key]) for key in both]
-    sorted_by_err_R_diff = list(sorted(stats, key=lambda tuple: tuple[1].error_R - tuple[2].error_R))
+
+    def err_R_diff(tuple):
+        return tuple[1].error_R - tuple[2].error_R
 
     def print_out(l):
         for k, r1, r2 in l:
@@ -767,19 +905,19 @@ def compare_stats_maps(stats_map1: dict, stats_map2: dict, difficulty, n_worst_e
     if n_worst_examples is not None:
 
         print("{} best examples for 1st map for diff={}".format(n_worst_examples, difficulty))
-        l = sorted_by_err_R_diff[:n_worst_examples]
+        l = heapq.nsmallest(n_worst_examples, stats, key=err_R_diff)
         print_out(l)
 
-        filtered1 = list(filter(lambda key_value: key_value[0] in keys1, sorted_by_err_R_diff))
+        filtered1 = filter(lambda key_value: key_value[0] in keys1, stats)
         print("{} best satisfying examples for 1st map for diff={}".format(n_worst_examples, difficulty))
-        print_out(filtered1[:n_worst_examples])
+        print_out(heapq.nsmallest(n_worst_examples, filtered1, key=err_R_diff))
 
         print("{} best examples for 2nd map for diff={}".format(n_worst_examples, difficulty))
-        print_out(sorted_by_err_R_diff[-n_worst_examples:])
+        print_out(heapq.nlargest(n_worst_examples, stats, key=err_R_diff)[::-1])
 
-        filtered2 = list(filter(lambda key_value: key_value[0] in keys2, sorted_by_err_R_diff))
+        filtered2 = filter(lambda key_value: key_value[0] in keys2, stats)
         print("{} best satisfying examples for 2nd map for diff={}".format(n_worst_examples, difficulty))
-        print_out(filtered2[-n_worst_examples:])
+        print_out(heapq.nlargest(n_worst_examples, filtered2, key=err_R_diff)[::-1])
 
     print("{}\t{:.03f}\t{:.03f}".format(difficulty, perc1, perc2))
     return difficulty, perc1, perc2
@@ -787,8 +925,7 @@ def compare_stats_maps(stats_map1: dict, stats_map2: dict, difficulty, n_worst_e
 
 def evaluate_percentage_correct_from_file(file_name, difficulty, n_worst_examples=None, th_degrees=5):
 
-    with open(file_name, "rb") as f:
-        stats_map = pickle.load(f)
+    stats_map = load_stats_map(file_name)
 
     print_significant_instances(stats_map, difficulty, key="default", n_examples=n_worst_examples)
     return evaluate_percentage_correct(stats_map, difficulty, th_degrees=th_degrees)
@@ -796,26 +933,17 @@ def evaluate_percentage_correct_from_file(file_name, difficulty, n_worst_example
 
 def evaluate_percentage_correct_from_files(file_name1, file_name2, difficulty, n_worst_examples=None, th_degrees=5):
 
-    with open(file_name1, "rb") as f:
-        stats_map1 = pickle.load(f)
-
-    with open(file_name2, "rb") as f:
-        stats_map2 = pickle.load(f)
+    stats_map1 = load_stats_map(file_name1)
+    stats_map2 = load_stats_map(file_name2)
 
     return compare_stats_maps(stats_map1, stats_map2, difficulty, n_worst_examples=n_worst_examples, th_degrees=th_degrees)
 
 
 def make_light(file_name):
 
-    with open(file_name, "rb") as f:
-        print("reading: {}".format(file_name))
-        stats_map = pickle.load(f)
-
-    for key_value in stats_map.items():
-        key_value[1].make_brief()
-
-    with open("{}_light".format(file_name), "wb") as f:
-        pickle.dump(stats_map, f)
+    print("reading: {}".format(file_name))
+    stats_map = load_stats_map(file_name)
+    save_stats_map(stats_map, "{}_light".format(file_name))
 
 
 def evaluate_file(scene_name, file_name):
@@ -1093,18 +1221,11 @@ def evaluate_normals_stats(stats_map):
 
     def shared_pairs(keys):
 
-        at_least_two_sets = {}
-        for k in keys:
-            at_least_two_sets[k] = set()
-            for img in normals_degrees[k]:
-                deg_list = normals_degrees[k][img]
-                if len(deg_list) > 0: #if valid_normals.get(img, 0) >= 2:
-                    at_least_two_sets[k].add(img)
+        #if valid_normals.get(img, 0) >= 2:
+        at_least_two_sets = {k: {img for img, deg_list in normals_degrees[k].items() if len(deg_list) > 0} for k in keys}
 
-        first_key = list(at_least_two_sets.keys())[0]
-        shared_keys = at_least_two_sets[first_key]
-        for k in at_least_two_sets:
-            shared_keys = shared_keys.intersection(at_least_two_sets[k])
+        # smallest first keeps the intermediate sets small
+        shared_keys = set.intersection(*sorted(at_least_two_sets.values(), key=len))
 
         return shared_keys, at_least_two_sets
 
@@ -1112,7 +1233,8 @@ def evaluate_normals_stats(stats_map):
 
     ms_None_1_0_25_0_8_list = ["frame_0000000165_2", "frame_0000000175_4", "frame_0000000220_4", "frame_0000000050_4", "frame_0000000095_1", "frame_0000000130_3", "frame_0000000105_1", "frame_0000000170_4", "frame_0000000130_2", "frame_0000000030_3", "frame_0000000230_1", "frame_0000000125_1", "frame_0000000035_4", "frame_0000000080_4", "frame_0000000220_3", "frame_0000000260_4", "frame_0000000125_3", "frame_0000000040_1", "frame_0000000100_4", "frame_0000000215_4", "frame_0000000235_4", "frame_0000000180_3", "frame_0000000145_3", "frame_0000000240_3", "frame_0000000085_2", "frame_0000000130_4", "frame_0000000045_2", "frame_0000000060_2", "frame_0000000180_4", "frame_0000000080_1", "frame_0000000110_1", "frame_0000000270_1", "frame_0000000210_1", "frame_0000000150_1", "frame_0000000140_3", "frame_0000000165_4", "frame_0000000045_1", "frame_0000000120_4", "frame_0000000205_4", "frame_0000000090_4", "frame_0000000165_1", "frame_0000000080_3", "frame_0000000160_4", "frame_0000000115_4", "frame_0000000190_1", "frame_0000000185_1", "frame_0000000190_4", "frame_0000000235_3", "frame_0000000245_3", "frame_0000000245_4", "frame_0000000050_2", "frame_0000000055_4", "frame_0000000250_3", "frame_0000000155_3", "frame_0000000040_2", "frame_0000000050_3", "frame_0000000220_1", "frame_0000000155_4", "frame_0000000060_3", "frame_0000000260_3", "frame_0000000105_3", "frame_0000000250_4", "frame_0000000255_4", "frame_0000000175_3", "frame_0000000060_4", "frame_0000000125_4", "frame_0000000150_4", "frame_0000000145_4", "frame_0000000145_2", "frame_0000000175_1", "frame_0000000225_1", "frame_0000000110_3", "frame_0000000095_3", "frame_0000000040_3", "frame_0000000035_3", "frame_0000000015_3", "frame_0000000090_2", "frame_0000000085_4", "frame_0000000065_4", "frame_0000000010_3", "frame_0000000100_1", "frame_0000000085_3", "frame_0000000240_4", "frame_0000000070_4", "frame_0000000115_3", "frame_0000000140_1", "frame_0000000085_1", "frame_0000000050_1", "frame_0000000070_2", "frame_0000000110_2", "frame_0000000150_3", "frame_0000000025_3", "frame_0000000075_1", "frame_0000000165_3", "frame_0000000045_3", "frame_0000000065_1", "frame_0000000195_1", "frame_0000000080_2", "frame_0000000115_2", "frame_0000000225_4", "frame_0000000020_3", "frame_0000000140_2", "frame_0000000155_1", "frame_0000000185_4", "frame_0000000170_2", "frame_0000000115_1", "frame_0000000065_2", "frame_0000000095_2", "frame_0000000210_4", "frame_0000000170_1", "frame_0000000185_3", "frame_0000000100_2", "frame_0000000215_3", "frame_0000000265_3", "frame_0000000135_2", "frame_0000000160_3", "frame_0000000075_2", "frame_0000000065_3", "frame_0000000095_4", "frame_0000000090_3", "frame_0000000265_4", "frame_0000000225_3", "frame_0000000120_1", "frame_0000000120_2", "frame_0000000130_1", "frame_0000000230_3", "frame_0000000100_3", "frame_0000000020_4", "frame_0000000195_4", "frame_0000000200_1", "frame_0000000255_3", "frame_0000000195_3", "frame_0000000190_3", "frame_0000000135_3", "frame_0000000180_1", "frame_0000000070_3", "frame_0000000055_1", "frame_0000000055_3", "frame_0000000260_1", "frame_0000000135_4", "frame_0000000125_2", "frame_0000000200_3", "frame_0000000060_1", "frame_0000000035_2", "frame_0000000205_1", "frame_0000000015_4", "frame_0000000210_3", "frame_0000000230_4", "frame_0000000120_3", "frame_0000000205_3", "frame_0000000075_3", "frame_0000000110_4", "frame_0000000140_4", "frame_0000000170_3", "frame_0000000145_1", "frame_0000000040_4", "frame_0000000075_4", "frame_0000000045_4", "frame_0000000160_1", "frame_0000000215_1", "frame_0000000135_1", "frame_0000000105_4", "frame_0000000105_2", "frame_0000000030_4", "frame_0000000265_1", "frame_0000000025_4", "frame_0000000070_1", "frame_0000000030_2", "frame_0000000090_1", "frame_0000000055_2"]
     ms_mean_0_s8_35_0_8_list = ["frame_0000000165_2", "frame_0000000175_2", "frame_0000000175_4", "frame_0000000220_4", "frame_0000000050_4", "frame_0000000095_1", "frame_0000000130_3", "frame_0000000105_1", "frame_0000000170_4", "frame_0000000130_2", "frame_0000000030_3", "frame_0000000125_1", "frame_0000000035_4", "frame_0000000080_4", "frame_0000000220_3", "frame_0000000260_4", "frame_0000000125_3", "frame_0000000040_1", "frame_0000000100_4", "frame_0000000215_4", "frame_0000000235_4", "frame_0000000145_3", "frame_0000000240_3", "frame_0000000085_2", "frame_0000000130_4", "frame_0000000045_2", "frame_0000000060_2", "frame_0000000180_4", "frame_0000000080_1", "frame_0000000110_1", "frame_0000000270_1", "frame_0000000210_1", "frame_0000000150_1", "frame_0000000140_3", "frame_0000000165_4", "frame_0000000045_1", "frame_0000000120_4", "frame_0000000205_4", "frame_0000000090_4", "frame_0000000165_1", "frame_0000000080_3", "frame_0000000160_4", "frame_0000000115_4", "frame_0000000190_1", "frame_0000000185_1", "frame_0000000190_4", "frame_0000000235_3", "frame_0000000245_3", "frame_0000000245_4", "frame_0000000050_2", "frame_0000000055_4", "frame_0000000250_3", "frame_0000000155_3", "frame_0000000040_2", "frame_0000000050_3", "frame_0000000220_1", "frame_0000000155_4", "frame_0000000060_3", "frame_0000000260_3", "frame_0000000105_3", "frame_0000000250_4", "frame_0000000060_4", "frame_0000000125_4", "frame_0000000150_4", "frame_0000000145_4", "frame_0000000145_2", "frame_0000000175_1", "frame_0000000225_1", "frame_0000000110_3", "frame_0000000150_2", "frame_0000000095_3", "frame_0000000040_3", "frame_0000000035_3", "frame_0000000015_3", "frame_0000000090_2", "frame_0000000085_4", "frame_0000000065_4", "frame_0000000010_3", "frame_0000000100_1", "frame_0000000085_3", "frame_0000000240_4", "frame_0000000070_4", "frame_0000000115_3", "frame_0000000140_1", "frame_0000000085_1", "frame_0000000050_1", "frame_0000000070_2", "frame_0000000110_2", "frame_0000000150_3", "frame_0000000025_3", "frame_0000000075_1", "frame_0000000165_3", "frame_0000000045_3", "frame_0000000065_1", "frame_0000000195_1", "frame_0000000080_2", "frame_0000000115_2", "frame_0000000225_4", "frame_0000000020_3", "frame_0000000140_2", "frame_0000000155_1", "frame_0000000185_4", "frame_0000000170_2", "frame_0000000115_1", "frame_0000000065_2", "frame_0000000095_2", "frame_0000000210_4", "frame_0000000170_1", "frame_0000000100_2", "frame_0000000215_3", "frame_0000000265_3", "frame_0000000135_2", "frame_0000000160_3", "frame_0000000075_2", "frame_0000000065_3", "frame_0000000095_4", "frame_0000000090_3", "frame_0000000265_4", "frame_0000000225_3", "frame_0000000160_2", "frame_0000000120_1", "frame_0000000120_2", "frame_0000000130_1", "frame_0000000230_3", "frame_0000000100_3", "frame_0000000195_4", "frame_0000000200_1", "frame_0000000195_3", "frame_0000000255_3", "frame_0000000135_3", "frame_0000000180_1", "frame_0000000070_3", "frame_0000000055_1", "frame_0000000055_3", "frame_0000000260_1", "frame_0000000135_4", "frame_0000000125_2", "frame_0000000200_3", "frame_0000000060_1", "frame_0000000035_2", "frame_0000000205_1", "frame_0000000210_3", "frame_0000000230_4", "frame_0000000120_3", "frame_0000000205_3", "frame_0000000075_3", "frame_0000000110_4", "frame_0000000140_4", "frame_0000000170_3", "frame_0000000145_1", "frame_0000000040_4", "frame_0000000155_2", "frame_0000000075_4", "frame_0000000045_4", "frame_0000000160_1", "frame_0000000215_1", "frame_0000000135_1", "frame_0000000105_4", "frame_0000000105_2", "frame_0000000030_4", "frame_0000000265_1", "frame_0000000025_4", "frame_0000000030_2", "frame_0000000090_1", "frame_0000000055_2"]
-    shared_at_least_two = ms_None_1_0_25_0_8_list
+    # hashed, as it is probed for every img of every key
+    shared_at_least_two = frozenset(ms_None_1_0_25_0_8_list)
 
     print("{} imgs are common to all keys".format(len(shared_at_least_two)))
 
@@ -1127,47 +1249,42 @@ def evaluate_normals_stats(stats_map):
     # stats2_extra_keys = at_least_2_planes[key2] - shared_for_2
     # print("extra: {},\n {}".format(stats1_extra_keys, stats2_extra_keys))
 
+    def avg(values):
+        return float(values.mean()) if len(values) > 0 else 0.0
+
     for param_key in normals_degrees:
-        # out = False
-        # if k.startswith("ms_None_1.0_25_0.8"):
-        #     out = True
-        count = 0
-        count_shared = 0
-        count_valid = 0
-        avg_l2 = 0.0
-        avg_l1 = 0.0
-        avg_l2_shared = 0.0
-        avg_l1_shared = 0.0
-        avg_l1_valid = 0.0
-        for img in normals_degrees[param_key]:
-            deg_list = normals_degrees[param_key][img]
-            if valid_normals[param_key][img] > 1:
-                count_valid = count_valid + 1
-                avg_l1_valid = avg_l1_valid + math.fabs(90.0 - deg_list[0])
-            if len(deg_list) > 0:
-                avg_l2 = avg_l2 + (90.0 - deg_list[0]) ** 2
-                avg_l1 = avg_l1 + math.fabs(90.0 - deg_list[0])
-                count = count + 1
-                if shared_at_least_two.__contains__(img):
-                    # if out:
-                    #     print("img: {}: {}".format(img, deg_list))
-                    #     print("normals: {}".format(normals[k][img]))
-                    avg_l2_shared = avg_l2_shared + (90.0 - deg_list[0]) ** 2
-                    avg_l1_shared = avg_l1_shared + math.fabs(90.0 - deg_list[0])
-                    count_shared = count_shared + 1
-
-        if count_valid > 0:
-            avg_l1_valid = avg_l1_valid / count_valid
-        if count > 0:
-            avg_l2 = avg_l2 / count
-            avg_l1 = avg_l1 / count
-        if count_shared > 0:
-            avg_l2_shared = avg_l2_shared / count_shared
-            avg_l1_shared = avg_l1_shared / count_shared
+        # aligned arrays over all the imgs (NaN for the ones with no degree value), the averages are then single
+        # masked numpy passes
+        img_degrees = normals_degrees[param_key]
+        img_valid_normals = valid_normals[param_key]
+        n_imgs = len(img_degrees)
+        all_diffs = 90.0 - np.fromiter((deg_list[0] if len(deg_list) > 0 else np.nan for deg_list in img_degrees.values()), dtype=np.float64, count=n_imgs)
+        has_degrees = ~np.isnan(all_diffs)
+        valid_mask = np.fromiter((img_valid_normals[img] > 1 for img in img_degrees), dtype=bool, count=n_imgs)[has_degrees]
+        shared_mask = np.fromiter((img in shared_at_least_two for img in img_degrees), dtype=bool, count=n_imgs)[has_degrees]
+        diffs = all_diffs[has_degrees]
+
+        count = len(diffs)
+        count_shared = int(np.count_nonzero(shared_mask))
+        count_valid = int(np.count_nonzero(valid_mask))
+        avg_l2 = avg(diffs ** 2)
+        avg_l1 = avg(np.abs(diffs))
+        avg_l2_shared = avg(diffs[shared_mask] ** 2)
+        avg_l1_shared = avg(np.abs(diffs[shared_mask]))
+        avg_l1_valid = avg(np.abs(diffs[valid_mask]))
         print("{} {:.3f} {} / {}".format(param_key, avg_l1, count, count_valid))
         print("{} - shared: {:.3f}/{} valid: {:.3f}/{}".format(param_key, avg_l1_shared, count_shared, avg_l1_valid, count_valid))
 
 
+def existing_file_names(dir_path):
+    """
+    :param dir_path: directory to list
+    :return: set of the names of the regular files in dir_path (one scandir instead of a stat per candidate)
+    """
+    with os.scandir(dir_path) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+
 def old_main():
 
     print("Started")
@@ -1183,9 +1300,10 @@ def old_main():
 
     # legacy
     if args.method == "make_light":
+        existing = existing_file_names(args.input_dir)
         for diff in range(18):
             file_path = "{}/stats_diff_{}.pkl".format(args.input_dir, diff)
-            if os.path.isfile(file_path):
+            if "stats_diff_{}.pkl".format(diff) in existing:
                 make_light(file_path)
             else:
                 print("{} not found".format(file_path))
@@ -1193,10 +1311,13 @@ def old_main():
     elif args.method == "compare":
         diff_percs = []
         n_worst = None if args.n_worst is None else int(args.n_worst)
+        existing1 = existing_file_names(args.input_dir)
+        existing2 = existing_file_names(args.input_dir2)
         for diff in range(18):
             file_path1 = "{}/stats_diff_{}.pkl".format(args.input_dir, diff)
             file_path2 = "{}/stats_diff_{}.pkl".format(args.input_dir2, diff)
-            if os.path.isfile(file_path1) and os.path.isfile(file_path2):
+            file_name = "stats_diff_{}.pkl".format(diff)
+            if file_name in existing1 and file_name in existing2:
                 diff_perc = evaluate_percentage_correct_from_files(file_path1, file_path2, diff, n_worst_examples=n_worst, th_degrees=5)
                 diff_percs.append(diff_perc)
             else:
@@ -1208,9 +1329,10 @@ def old_main():
     else:
         diff_percs = []
         n_worst = None if args.n_worst is None else int(args.n_worst)
+        existing = existing_file_names(args.input_dir)
         for diff in range(18):
             file_path = "{}/stats_diff_{}.pkl_light".format(args.input_dir, diff)
-            if os.path.isfile(file_path):
+            if "stats_diff_{}.pkl_light".format(diff) in existing:
                 diff_perc = evaluate_percentage_correct_from_file(file_path, diff, n_worst_examples=n_worst, th_degrees=5)
                 diff_percs.append(diff_perc)
             else:
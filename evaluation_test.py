@@ -0,0 +1,187 @@
+import pickle
+from dataclasses import dataclass
+from typing import List
+
+import cv2 as cv
+import numpy as np
+
+import evaluation
+from evaluation import Stats, ImageData, ImageSerializedData, save_stats_map, load_stats_map
+
+
+def get_stats(seed):
+    rng = np.random.default_rng(seed)
+    return Stats(inliers_against_gt=np.array([10, 20, 30, 40, 50]),
+                 tentatives_1=rng.uniform(0, 1000, (100, 2)),
+                 tentatives_2=rng.uniform(0, 1000, (100, 2)),
+                 error_R=np.float64(0.5 + seed),
+                 error_T=1.5,
+                 tentative_matches=100,
+                 inliers=50,
+                 all_features_1=8000,
+                 all_features_2=7000,
+                 E=rng.uniform(-1, 1, (3, 3)),
+                 normals1=rng.uniform(-1, 1, (2, 3)),
+                 normals2=None)
+
+
+def stats_to_dict(obj):
+    """
+    Stats (possibly nested in dicts) => plain dicts, so that np.testing.assert_equal can compare them
+    """
+    if isinstance(obj, Stats):
+        return {name: getattr(obj, name) for name in Stats.__slots__}
+    elif isinstance(obj, dict):
+        return {k: stats_to_dict(v) for k, v in obj.items()}
+    else:
+        return obj
+
+
+def test_save_load_stats_map(tmp_path):
+    stats_map = {"img1_img2": get_stats(0), "img3_img4": get_stats(1)}
+    # legacy/hand made stats may hold tuples
+    stats_map["img3_img4"].inliers_against_gt = (1, 2, 3)
+
+    file_name = str(tmp_path / "all.stats.pkl_light")
+    save_stats_map(stats_map, file_name)
+    read = load_stats_map(file_name)
+
+    assert list(read.keys()) == list(stats_map.keys())
+    np.testing.assert_equal(stats_to_dict(read), stats_to_dict(stats_map))
+    assert read["img3_img4"].inliers_against_gt == (1, 2, 3)
+
+
+def test_load_stats_map_pickle_fallback(tmp_path):
+    # as pickled by the pipeline: {stats key: {difficulty: {img pair: Stats}}}
+    stats_map = {"default": {0: {"img1_img2": get_stats(0)}, 1: {"img3_img4": get_stats(1)}}}
+
+    file_name = str(tmp_path / "all.stats.pkl")
+    with open(file_name, "wb") as f:
+        pickle.dump(stats_map, f)
+    read = load_stats_map(file_name)
+
+    np.testing.assert_equal(stats_to_dict(read), stats_to_dict(stats_map))
+
+
+# the dataclasses as they were pickled before __slots__ (i.e. with the __dict__ state)
+@dataclass
+class LegacyStats:
+    inliers_against_gt: (int, int, int)
+    tentatives_1: (float, float)
+    tentatives_2: (float, float)
+    error_R: float
+    error_T: float
+    tentative_matches: int
+    inliers: int
+    all_features_1: int
+    all_features_2: int
+    E: np.ndarray
+    normals1: np.ndarray
+    normals2: np.ndarray
+
+    def make_brief(self):
+        self.src_pts_inliers = None
+        self.dst_pts_inliers = None
+        self.src_tentatives = None
+        self.dst_tentatives = None
+        self.kpts1 = None
+        self.kpts2 = None
+
+
+@dataclass
+class LegacyImageData:
+    img: np.ndarray
+    key_points: List[cv.KeyPoint]
+    descriptions: object
+    real_K: np.ndarray
+    normals: np.ndarray
+    ts_phis: object
+    components_indices: np.ndarray
+    valid_components_dict: dict
+
+
+@dataclass
+class LegacyImageSerializedData:
+    kpts: list
+    descs: list
+    normals: np.ndarray
+    components_indices: np.ndarray
+    valid_components_dict: dict
+
+
+def pickle_as_legacy(monkeypatch, legacy_obj, name):
+    """
+    :return: legacy_obj pickled as evaluation.<name> (as the baseline format)
+    """
+    legacy_class = type(legacy_obj)
+    module, qualname = legacy_class.__module__, legacy_class.__qualname__
+    legacy_class.__module__, legacy_class.__qualname__ = "evaluation", name
+    try:
+        with monkeypatch.context() as m:
+            m.setattr(evaluation, name, legacy_class)
+            return pickle.dumps(legacy_obj)
+    finally:
+        legacy_class.__module__, legacy_class.__qualname__ = module, qualname
+
+
+def test_unpickle_legacy_stats(monkeypatch):
+    stats = get_stats(0)
+    legacy_stats = LegacyStats(**stats_to_dict(stats))
+    legacy_stats.make_brief()
+
+    read = pickle.loads(pickle_as_legacy(monkeypatch, legacy_stats, "Stats"))
+
+    assert type(read) is Stats
+    np.testing.assert_equal(stats_to_dict(read), stats_to_dict(stats))
+    assert not hasattr(read, "kpts1")
+
+
+def get_key_points():
+    return [cv.KeyPoint(1.0, 2.0, 3.0), cv.KeyPoint(4.0, 5.0, 6.0)]
+
+
+def test_unpickle_legacy_img_data(monkeypatch):
+    legacy_img_data = LegacyImageData(img=np.zeros((4, 6, 3), dtype=np.uint8),
+                                      key_points=get_key_points(),
+                                      descriptions=np.ones((2, 128), dtype=np.float32),
+                                      real_K=np.eye(3),
+                                      normals=np.array([[0.0, 0.0, -1.0]]),
+                                      ts_phis=None,
+                                      components_indices=np.zeros((4, 6), dtype=np.int32),
+                                      valid_components_dict={0: 0})
+
+    read = pickle.loads(pickle_as_legacy(monkeypatch, legacy_img_data, "ImageData"))
+
+    assert type(read) is ImageData
+    np.testing.assert_equal(read.descriptions, legacy_img_data.descriptions)
+    np.testing.assert_equal(read.components_indices, legacy_img_data.components_indices)
+    assert read.valid_components_dict == {0: 0}
+    np.testing.assert_equal(read.get_key_points_xy(), np.array([[1.0, 2.0], [4.0, 5.0]]))
+
+    # and the slotted ImageData round trips as well
+    read2 = pickle.loads(pickle.dumps(read))
+    np.testing.assert_equal(read2.get_key_points_xy(), read.get_key_points_xy())
+
+
+def test_unpickle_legacy_img_serialized_data(monkeypatch):
+    legacy_data = LegacyImageSerializedData(kpts=get_key_points(),
+                                            descs=np.ones((2, 128), dtype=np.float32),
+                                            normals=np.array([[0.0, 0.0, -1.0]]),
+                                            components_indices=np.zeros((4, 6), dtype=np.int32),
+                                            valid_components_dict={0: 0})
+
+    read = pickle.loads(pickle_as_legacy(monkeypatch, legacy_data, "ImageSerializedData"))
+
+    assert type(read) is ImageSerializedData
+    assert [kp.pt for kp in read.kpts] == [kp.pt for kp in legacy_data.kpts]
+    np.testing.assert_equal(read.descs, legacy_data.descs)
+    np.testing.assert_equal(read.normals, legacy_data.normals)
+
+
+def test_key_points_xy_cache_cleared_on_assignment():
+    img_data = ImageData(img=None, key_points=get_key_points(), descriptions=None, real_K=None, normals=None,
+                         ts_phis=None, components_indices=None, valid_components_dict=None)
+    np.testing.assert_equal(img_data.get_key_points_xy(), np.array([[1.0, 2.0], [4.0, 5.0]]))
+
+    img_data.key_points = [cv.KeyPoint(7.0, 8.0, 9.0)]
+    np.testing.assert_equal(img_data.get_key_points_xy(), np.array([[7.0, 8.0]]))
@@ -1,3 +1,5 @@
+import functools
+
 import kornia as K
 import kornia.feature as KF
 import numpy as np
@@ -6,8 +8,8 @@ import torch.nn.functional as F
 from kornia.utils import batched_forward
 from kornia_moons.feature import *
 
-from affnet import show_sets_of_linear_maps
-from transforms import get_rectification_rotations
+from affnet import show_sets_of_linear_maps, get_kpts_hom
+from transforms import get_rectification_rotations, invert_calibration_matrix_torch
 from utils import Timer, timer_label_decorator
 from transforms import homographies_jacobians
 
@@ -18,6 +20,20 @@ DISCLAIMER: originally taken from https://github.com/kornia/kornia-examples/blob
 HARD_NET_LABEL = "HardNet"
 
 
+@functools.lru_cache(maxsize=8)
+def _get_K_K_inv(K_bytes, K_shape, K_dtype, device):
+    """
+    :param K_bytes: K.tobytes() of the calibration matrix - so that the same camera is converted only once
+    :param K_shape: K.shape
+    :param K_dtype: K.dtype.str
+    :param device:
+    :return: K_torch, K_inv_torch - both torch.float32 on device
+    """
+    K_np = np.frombuffer(K_bytes, dtype=np.dtype(K_dtype)).reshape(K_shape)
+    K_torch = torch.from_numpy(K_np.copy()).to(dtype=torch.float32, device=device)
+    return K_torch, invert_calibration_matrix_torch(K_torch)
+
+
 class HardNetDescriptor:
 
     def __init__(self, sift_descriptor, compute_laffs, filter=None, device: torch.device=torch.device('cpu')):
@@ -149,8 +165,8 @@ class HardNetDescriptor:
         normals = normals[kps_long[:, 1], kps_long[:, 0]]
 
         Rs = get_rectification_rotations(normals, self.device)
-        K_torch = torch.from_numpy(self.custom_K).to(dtype=torch.float32, device=self.device)
-        Hs = K_torch @ Rs @ torch.inverse(K_torch)
+        K_torch, K_inv_torch = _get_K_K_inv(self.custom_K.tobytes(), self.custom_K.shape, self.custom_K.dtype.str, self.device)
+        Hs = K_torch @ Rs @ K_inv_torch
         return Hs
 
     def batch_and_invert_affines(self, affines, cv2_sift_kpts, timg):
@@ -180,7 +196,7 @@ class HardNetDescriptor:
     def get_lafs_from_normals(self, cv2_sift_kpts, timg):
 
         Hs = self.get_Hs_from_custom_normals(cv2_sift_kpts, timg)
-        points_hom = torch.tensor([(*cv2_sift_kpt.pt, 1) for cv2_sift_kpt in cv2_sift_kpts], device=self.device)
+        points_hom = get_kpts_hom(cv2_sift_kpts).to(self.device)
         affines = homographies_jacobians(Hs, points_hom, self.device)
         affines = self.batch_and_invert_affines(affines, cv2_sift_kpts, timg)
         affines[:, :, :, 2] = points_hom[:, :2]
@@ -2,6 +2,7 @@ import imp
 import math
 import time
 
+import matplotlib
 import matplotlib.pyplot as plt
 import cv2 as cv
 import numpy as np
@@ -68,11 +69,17 @@ def show_point_cloud(points_x, points_y, points_z):
     show_or_close(True)
 
 
-def show_or_close(show):
+def show_or_close(show, fig=None):
+    """
+    :param show: show the figure, otherwise close it
+    :param fig: the figure to close, None - the current one
+    """
     if show:
         plt.show(block=False)
-    else:
+    elif fig is None:
         plt.close()
+    else:
+        plt.close(fig)
 
 
 def show_imgs(img_paths):
@@ -120,15 +127,20 @@ def show_and_save_normal_clusters_3d(normals, clustered_normals, normal_indices,
 
     ax.plot(0, 0, 0, 'o', color="black", markersize=2.0)
 
-    rel_normals = normals[normal_indices == 3]
-    ax.plot((rel_normals[::10, 0]), (rel_normals[::10, 2]), (rel_normals[::10, 1]), '.', color="yellow", markersize=0.5)
-    ax.plot((-rel_normals[::10, 0]), (-rel_normals[::10, 2]), (-rel_normals[::10, 1]), '.', color="yellow", markersize=0.5)
-
+    # all the groups go into a single scatter - an ax.plot per group is a separate artist each
+    rel_normals = normals[normal_indices == 3][::10]
+    point_groups = [rel_normals, -rel_normals]
+    group_colors = ["yellow", "yellow"]
     for i in range(len(clustered_normals)):
-        rel_normals = normals[normal_indices == i]
-        ax.plot((rel_normals[::10, 0]), (rel_normals[::10, 2]), (rel_normals[::10, 1]), '.', color=cluster_color_names[i], markersize=0.5)
+        point_groups.append(normals[normal_indices == i][::10])
+        group_colors.append(cluster_color_names[i])
         # NOTE comment this for better # visualizations
-        #ax.plot((-rel_normals[::10, 0]), (-rel_normals[::10, 2]), (-rel_normals[::10, 1]), '.', color=cluster_color_names[i], markersize=0.5)
+        #point_groups.append(-point_groups[-1])
+        #group_colors.append(cluster_color_names[i])
+
+    points = np.concatenate(point_groups)
+    colors = np.repeat(matplotlib.colors.to_rgba_array(group_colors), [len(g) for g in point_groups], axis=0)
+    ax.scatter(points[:, 0], points[:, 2], points[:, 1], c=colors, s=0.25, marker='.')
 
     if len(clustered_normals.shape) == 1:
         clustered_normals = np.expand_dims(clustered_normals, axis=0)
@@ -149,18 +161,17 @@ def show_and_save_normal_clusters_3d(normals, clustered_normals, normal_indices,
     ax.set_zticks([-1, 0, 1])
 
     if show:
-        for i in range(clustered_normals.shape[0] - 1):
-            for j in range(i + 1, clustered_normals.shape[0]):
-                angle = np.arccos(np.dot(clustered_normals[i], clustered_normals[j]))
-                angle_degrees = 180 / math.pi * angle
-                print("angle between normal {} and {}: {} degrees".format(i, j, angle_degrees))
+        angles_degrees = np.degrees(np.arccos(clustered_normals @ clustered_normals.T))
+        for i, j in zip(*np.triu_indices(clustered_normals.shape[0], k=1)):
+            print("angle between normal {} and {}: {} degrees".format(i, j, angles_degrees[i, j]))
 
     # NOTE: first save, then show!!!
     if save:
         out_path = '{}/{}_point_cloud.jpg'.format(out_dir, img_name[:-4])
         plt.savefig(out_path)
 
-    show_or_close(show)
+    # closed explicitly, pyplot keeps every figure alive otherwise (across the whole dataset pass)
+    show_or_close(show, fig)
 
 
 def show_normals_components(normals, title, figsize=None):
@@ -0,0 +1,140 @@
+import cv2 as cv
+import kornia as K
+import kornia.feature as KF
+import numpy as np
+import torch
+
+from utils import Timer
+
+"""
+DISCLAIMER: the detector setup follows the SIFT example from the kornia docs (kornia.feature.ScaleSpaceDetector with DoG)
+"""
+
+KORNIA_SIFT_LABEL = "KorniaSIFT"
+
+
+class KorniaSIFTDescriptor:
+    """
+    SIFT (DoG detector + SIFT descriptor) from kornia as a drop-in replacement of cv.SIFT (detect/detectAndCompute
+    returning cv.KeyPoint and np.ndarray) which runs on the device - i.e. on the GPU if available. The modules are
+    created once and kept on the device, so that they are reused across the images.
+    """
+
+    PATCH_SIZE = 41
+    MR_SIZE = 6.0
+
+    def __init__(self, n_features=None, device: torch.device = torch.device('cpu')):
+        self.device = device
+        n_features = 8000 if n_features is None else n_features
+        # NOTE the subpixel/nms module is passed positionally - it's 'nms_module' in older and 'subpix_module' in newer kornia
+        self.detector = KF.ScaleSpaceDetector(n_features,
+                                              KorniaSIFTDescriptor.MR_SIZE,
+                                              K.geometry.ScalePyramid(3, 1.6, KorniaSIFTDescriptor.PATCH_SIZE, double_image=True),
+                                              KF.BlobDoG(),
+                                              K.geometry.ConvQuadInterp3d(10),
+                                              ori_module=KF.LAFOrienter(19),
+                                              minima_are_also_good=True,
+                                              scale_space_response=True).to(device).eval()
+        self.descriptor = KF.SIFTDescriptor(KorniaSIFTDescriptor.PATCH_SIZE, rootsift=False).to(device).eval()
+
+    def img_to_tensor(self, img):
+        if len(img.shape) == 2:
+            timg = K.image_to_tensor(img, False).float() / 255.
+        elif len(img.shape) == 3:
+            timg = K.color.rgb_to_grayscale(K.image_to_tensor(img, False).float() / 255.)
+        else:
+            raise Exception("Unexpected shape of the img: {}".format(img.shape))
+        return timg.to(self.device)
+
+    @staticmethod
+    def filter_by_mask(lafs, responses, mask):
+        """
+        :param lafs: torch.Tensor(1, N, 2, 3)
+        :param responses: torch.Tensor(1, N)
+        :param mask: np.ndarray(H, W) - as in cv.Feature2D.detect, only the key points on non zero pixels are kept
+        :return: lafs, responses
+        """
+        if mask is None:
+            return lafs, responses
+        xy = KF.get_laf_center(lafs)[0].round().long().cpu().numpy()
+        xy[:, 0] = np.clip(xy[:, 0], 0, mask.shape[1] - 1)
+        xy[:, 1] = np.clip(xy[:, 1], 0, mask.shape[0] - 1)
+        keep = torch.from_numpy(np.asarray(mask)[xy[:, 1], xy[:, 0]] != 0).to(lafs.device)
+        return lafs[:, keep], responses[:, keep]
+
+    @staticmethod
+    def kps_from_lafs(lafs, responses):
+        """
+        Inverse to kornia_moons' laf_from_opencv_SIFT_kpts
+        :param lafs: torch.Tensor(1, N, 2, 3)
+        :param responses: torch.Tensor(1, N)
+        :return: list of cv.KeyPoint
+        """
+        xys = KF.get_laf_center(lafs)[0].cpu().numpy()
+        sizes = (KF.get_laf_scale(lafs)[0, :, 0, 0] / KorniaSIFTDescriptor.MR_SIZE).cpu().numpy()
+        angles = np.mod(-KF.get_laf_orientation(lafs)[0, :, 0].cpu().numpy(), 360.0)
+        responses = responses[0].cpu().numpy()
+        return [cv.KeyPoint(float(xy[0]), float(xy[1]), float(size), float(angle), float(response))
+                for xy, size, angle, response in zip(xys, sizes, angles, responses)]
+
+    def detect_lafs(self, timg, mask=None):
+        label = Timer.start_check_point("detect in KorniaSIFT", tags=[KORNIA_SIFT_LABEL])
+        lafs, responses = self.detector(timg)
+        lafs, responses = KorniaSIFTDescriptor.filter_by_mask(lafs, responses, mask)
+        Timer.end_check_point(label)
+        return lafs, responses
+
+    def detect(self, img, mask=None):
+        with torch.no_grad():
+            lafs, responses = self.detect_lafs(self.img_to_tensor(img), mask)
+            return KorniaSIFTDescriptor.kps_from_lafs(lafs, responses)
+
+    def detectAndCompute(self, img, mask=None):
+        with torch.no_grad():
+            timg = self.img_to_tensor(img)
+            lafs, responses = self.detect_lafs(timg, mask)
+            if lafs.shape[1] == 0:
+                return [], None
+
+            label = Timer.start_check_point("KorniaSIFT.descriptors computation", tags=[KORNIA_SIFT_LABEL])
+            patches = KF.extract_patches_from_pyramid(timg, lafs, KorniaSIFTDescriptor.PATCH_SIZE)
+            B, N, CH, H, W = patches.size()
+            descs = self.descriptor(patches.view(B * N, CH, H, W)).view(B * N, -1)
+            # moved to the host just once
+            descs = descs.cpu().numpy()
+            Timer.end_check_point(label)
+
+            return KorniaSIFTDescriptor.kps_from_lafs(lafs, responses), descs
+
+    def detectAndCompute_batch(self, imgs):
+        """
+        detectAndCompute for several images - the images of the same size are detected and described in a single batch
+        (padding them to a common size would change the responses and so the key points close to the borders)
+        :param imgs: list of np.ndarray images
+        :return: list of (kps, descs) - as detectAndCompute for every image
+        """
+        ret = [None] * len(imgs)
+        with torch.no_grad():
+            timgs = [self.img_to_tensor(img) for img in imgs]
+            shapes_indices = {}
+            for i, timg in enumerate(timgs):
+                shapes_indices.setdefault(tuple(timg.shape[2:]), []).append(i)
+
+            for indices in shapes_indices.values():
+                batch = torch.cat([timgs[i] for i in indices])
+                lafs, responses = self.detect_lafs(batch)
+
+                label = Timer.start_check_point("KorniaSIFT.descriptors computation", tags=[KORNIA_SIFT_LABEL])
+                patches = KF.extract_patches_from_pyramid(batch, lafs, KorniaSIFTDescriptor.PATCH_SIZE)
+                B, N, CH, H, W = patches.size()
+                descs = self.descriptor(patches.view(B * N, CH, H, W)).view(B, N, -1)
+                # moved to the host just once
+                descs = descs.cpu().numpy()
+                Timer.end_check_point(label)
+
+                for b, i in enumerate(indices):
+                    if N == 0:
+                        ret[i] = ([], None)
+                    else:
+                        ret[i] = (KorniaSIFTDescriptor.kps_from_lafs(lafs[b:b + 1], responses[b:b + 1]), descs[b])
+        return ret
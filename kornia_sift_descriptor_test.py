@@ -0,0 +1,69 @@
+import cv2 as cv
+import numpy as np
+
+from kornia_sift_descriptor import KorniaSIFTDescriptor
+
+
+def get_synthetic_img(height, width, seed=0):
+    """
+    :return: np.ndarray(H, W, 3) of uint8 - random blobs (for the DoG detector) on a gray background
+    """
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 128, dtype=np.uint8)
+    for _ in range(40):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        radius = int(rng.integers(2, 10))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv.circle(img, center, radius, color, thickness=-1)
+    return cv.GaussianBlur(img, (3, 3), 0)
+
+
+def test_detect_and_compute():
+    descriptor = KorniaSIFTDescriptor(n_features=100)
+    img = get_synthetic_img(120, 160)
+
+    kps, descs = descriptor.detectAndCompute(img)
+
+    assert 0 < len(kps) <= 100
+    assert descs.shape == (len(kps), 128)
+    assert descs.dtype == np.float32
+    for kp in kps:
+        assert 0 <= kp.pt[0] < img.shape[1] and 0 <= kp.pt[1] < img.shape[0]
+
+    # detect gives the same key points
+    kps_only = descriptor.detect(img)
+    assert [kp.pt for kp in kps_only] == [kp.pt for kp in kps]
+
+
+def test_detect_and_compute_mask():
+    descriptor = KorniaSIFTDescriptor(n_features=100)
+    img = get_synthetic_img(120, 160)
+
+    mask = np.zeros(img.shape[:2], dtype=np.uint8)
+    mask[:, :80] = 1
+    kps, descs = descriptor.detectAndCompute(img, mask)
+    assert len(kps) > 0
+    assert descs.shape == (len(kps), 128)
+    assert all(round(kp.pt[0]) < 80 for kp in kps)
+
+    # no key points at all
+    kps, descs = descriptor.detectAndCompute(img, np.zeros(img.shape[:2], dtype=np.uint8))
+    assert kps == []
+    assert descs is None
+
+
+def test_detect_and_compute_batch():
+    descriptor = KorniaSIFTDescriptor(n_features=100)
+    # two of the same size (one batch) and a differently sized one
+    imgs = [get_synthetic_img(120, 160, seed=0), get_synthetic_img(96, 128, seed=1), get_synthetic_img(120, 160, seed=2)]
+
+    batched = descriptor.detectAndCompute_batch(imgs)
+
+    assert len(batched) == len(imgs)
+    for img, (batch_kps, batch_descs) in zip(imgs, batched):
+        kps, descs = descriptor.detectAndCompute(img)
+        assert len(batch_kps) == len(kps)
+        # the batched convolutions are not bitwise identical
+        np.testing.assert_allclose([kp.pt for kp in batch_kps], [kp.pt for kp in kps], atol=1e-3)
+        np.testing.assert_allclose([kp.size for kp in batch_kps], [kp.size for kp in kps], atol=1e-3)
+        np.testing.assert_allclose(batch_descs, descs, atol=1e-3)
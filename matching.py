@@ -75,22 +75,41 @@ def draw_matches(kps1, kps2, tentative_matches, H, inlier_mask, img1, img2):
 
 def rich_split_points(tentative_matches, kps1, dsc1, kps2, dsc2):
 
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in tentative_matches]).reshape(-1, 2)
+    src_pts, dst_pts = split_points(tentative_matches, kps1, kps2)
+
     src_kps = [kps1[m.queryIdx] for m in tentative_matches]
     src_dsc = [dsc1[m.queryIdx] for m in tentative_matches]
 
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in tentative_matches]).reshape(-1, 2)
     dst_kps = [kps2[m.trainIdx] for m in tentative_matches]
     dst_dsc = [dsc2[m.trainIdx] for m in tentative_matches]
 
     return src_pts, src_kps, src_dsc, dst_pts, dst_kps, dst_dsc
 
 
-def get_cross_checked_tentatives(matcher, img_data1, img_data2, ratio_threshold):
+def float32_descriptions(img_data):
+    """
+    :param img_data: ImageData
+    :return: img_data.descriptions as float32 (e.g. the FLANN kd-tree needs float32) - the quantized (uint8) descriptors
+    are just converted to a local copy, img_data itself is left intact
+    """
+    descs = img_data.descriptions
+    if descs.dtype != np.float32:
+        descs = descs.astype(np.float32)
+    return descs
+
 
-    knn_matches = matcher.knnMatch(img_data1.descriptions, img_data2.descriptions, k=2)
+def get_cross_checked_tentatives(matcher, img_data1, img_data2, ratio_threshold, descs1=None, descs2=None):
+    """
+    :param descs1: descriptions of img_data1 to match (e.g. converted to float32), img_data1.descriptions if None
+    :param descs2: descriptions of img_data2 to match (e.g. converted to float32), img_data2.descriptions if None
+    """
+
+    descs1 = img_data1.descriptions if descs1 is None else descs1
+    descs2 = img_data2.descriptions if descs2 is None else descs2
+
+    knn_matches = matcher.knnMatch(descs1, descs2, k=2)
     # For cross-check - TODO does is work for flann?
-    matches2 = matcher.match(img_data2.descriptions, img_data1.descriptions)
+    matches2 = matcher.match(descs2, descs1)
 
     tentative_matches = []
     for m, n in knn_matches:
@@ -101,13 +120,13 @@ def get_cross_checked_tentatives(matcher, img_data1, img_data2, ratio_threshold)
 
     filter_on_planes_during_correspondence = False
     if is_rectified_condition(img_data1) and filter_on_planes_during_correspondence:
-        tentative_matches = filter_during_correspondence(matcher, tentative_matches, matches2, img_data1, img_data2, ratio_threshold)
+        tentative_matches = filter_during_correspondence(matcher, tentative_matches, matches2, img_data1, img_data2, ratio_threshold, descs1, descs2)
     return tentative_matches
 
 
-def filter_during_correspondence(matcher, tentative_matches, all_matches_reversed, img_data1, img_data2, ratio_threshold):
+def filter_during_correspondence(matcher, tentative_matches, all_matches_reversed, img_data1, img_data2, ratio_threshold, descs1, descs2):
 
-    src_pts, dst_pts = split_points(tentative_matches, img_data1.key_points, img_data2.key_points)
+    src_pts, dst_pts = split_points(tentative_matches, img_data1.get_key_points_xy(), img_data2.get_key_points_xy())
 
     stats, unique, counts = get_normals_stats([img_data1, img_data2], src_pts, dst_pts)
     print("Matching stats in get_cross_checked_tentatives:")
@@ -115,8 +134,8 @@ def filter_during_correspondence(matcher, tentative_matches, all_matches_reverse
 
     max_set = get_filter(stats, unique, counts, img_data1.normals.shape[0], img_data2.normals.shape[0])
 
-    all_src_pts = np.float32([img_data1.key_points[m.trainIdx].pt for m in all_matches_reversed]).reshape(-1, 2)
-    all_dst_pts = np.float32([img_data2.key_points[m.queryIdx].pt for m in all_matches_reversed]).reshape(-1, 2)
+    # the matches are reversed, i.e. queryIdx indexes img_data2
+    all_dst_pts, all_src_pts = split_points(all_matches_reversed, img_data2.get_key_points_xy(), img_data1.get_key_points_xy())
     all_matches_stats, all_uniques, all_counts = get_normals_stats([img_data1, img_data2], all_src_pts, all_dst_pts)
     print("Matching stats of all matches in get_cross_checked_tentatives before filtering:")
     print("unique plane correspondence counts:\n{}".format(np.vstack((all_uniques.T, all_counts)).T))
@@ -126,7 +145,7 @@ def filter_during_correspondence(matcher, tentative_matches, all_matches_reverse
     unchecked_adds = 0
     tentative_matches = []
 
-    knn_matches = matcher.knnMatch(img_data1.descriptions, img_data2.descriptions, k=3)
+    knn_matches = matcher.knnMatch(descs1, descs2, k=3)
 
     for knn_match in knn_matches:
         for match_idx, match in enumerate(knn_match):
@@ -223,12 +242,16 @@ def find_correspondences(img_data1,
     assert img_data1.descriptions is not None and len(img_data1.descriptions) != 0
     assert img_data2.descriptions is not None and len(img_data2.descriptions) != 0
 
+    # quantized (uint8) descriptors are just stored compactly, the FLANN kd-tree needs float32
+    descs1 = float32_descriptions(img_data1)
+    descs2 = float32_descriptions(img_data2)
+
     if fginn:
         k = 10 + num_nn
-        knn_matches = matcher.knnMatch(img_data1.descriptions, img_data2.descriptions, k=k)
-        tentative_matches = filter_fginn_matches(knn_matches, img_data1.descriptions, img_data2.descriptions, num_nn, cfg)
+        knn_matches = matcher.knnMatch(descs1, descs2, k=k)
+        tentative_matches = filter_fginn_matches(knn_matches, descs1, descs2, num_nn, cfg)
     else:
-        tentative_matches = get_cross_checked_tentatives(matcher, img_data1, img_data2, ratio_thresh)
+        tentative_matches = get_cross_checked_tentatives(matcher, img_data1, img_data2, ratio_thresh, descs1, descs2)
 
     if show or save:
         tentative_matches_in_singleton_list = [[m] for m in tentative_matches]
@@ -322,7 +345,8 @@ def get_kts_desc_normal_list(image_data: ImageData, merge_components: bool):
 
 
 def apply_inliers_on_list(l: list, inlier_mask):
-    return [i for idx, i in enumerate(l) if inlier_mask[idx, 0] == 1]
+    # one vectorized comparison instead of a numpy scalar comparison per element
+    return [l[idx] for idx in np.flatnonzero(inlier_mask[:, 0] == 1)]
 
 
 def find_and_draw_homography_or_fallback(img1, kps1, descs1, img2, kps2, descs2,
@@ -508,8 +532,8 @@ def match_images_with_dominant_planes(image_data1: ImageData, image_data2: Image
 
         src_pts_rest, dst_pts_rest = split_points(tentative_matches_rest, rest_kpts1_l, rest_kpts2_l)
 
-        src_pts = np.float32([kps1.pt for kps1 in kps1_l]).reshape(-1, 2)
-        dst_pts = np.float32([kps2.pt for kps2 in kps2_l]).reshape(-1, 2)
+        src_pts = kps_to_xy(kps1_l)
+        dst_pts = kps_to_xy(kps2_l)
 
         src_pts = np.vstack((src_pts, src_pts_rest))
         dst_pts = np.vstack((dst_pts, dst_pts_rest))
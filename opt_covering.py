@@ -21,6 +21,8 @@ class CoveringParams:
     ts_opt: list
     phis_opt: list
     name: str
+    # dtype of the centers, the data are voted in it as well (the distance matrix is memory bound)
+    dtype: torch.dtype = torch.float32
 
     @staticmethod
     def log_1_8_covering():
@@ -121,34 +123,71 @@ class CoveringParams:
             raise ValueError("Unknown covering type: {}".format(covering_type))
 
     def covering_coordinates(self):
-        t_phi_list = []
-        for index, t_opt in enumerate(self.ts_opt):
-            for phi in torch.arange(start=0.0, end=math.pi, step=self.phis_opt[index]):
-                t_phi_list.append((t_opt, phi))
-
-        return torch.tensor(t_phi_list).T
+        """
+        :return: torch.Tensor(2, N) - (t, phi) of the centers, built once and cached as it only depends
+        on ts_opt and phis_opt (the callers only read it)
+        """
+        cached = self.__dict__.get("covering_coordinates_cache")
+        if cached is None:
+            # same length as torch.arange(0, pi, step), the bands are written straight into their slices
+            counts = [int(math.ceil(math.pi / self.phis_opt[index])) for index in range(len(self.ts_opt))]
+            cached = torch.empty(2, sum(counts), dtype=self.dtype)
+            offset = 0
+            for index, t_opt in enumerate(self.ts_opt):
+                n = counts[index]
+                cached[0, offset:offset + n] = float(t_opt)
+                torch.arange(start=0.0, end=math.pi, step=self.phis_opt[index], out=cached[1, offset:offset + n])
+                offset += n
+            self.__dict__["covering_coordinates_cache"] = cached
+        return cached
 
     def covering_coordinates_count(self):
         # include the identity class
-        count = 1
-        for index in range(len(self.ts_opt)):
-            count = count + len(torch.arange(start=0.0, end=math.pi, step=self.phis_opt[index]))
-        return count
+        return self.covering_coordinates().shape[1] + 1
 
 
 def distance_matrix(t1, t2, phi1, phi2):
     """
     t1, t2 tilts, not their logs!!
     """
-    t1 = t1.unsqueeze(1).expand(-1, t2.shape[0])
-    phi1 = phi1.unsqueeze(1).expand(-1, phi2.shape[0])
-    t2 = t2.unsqueeze(0).expand(t1.shape[0], -1)
-    phi2 = phi2.unsqueeze(0).expand(phi1.shape[0], -1)
-    dist = (t1 / t2 + t2 / t1) * torch.cos(phi1 - phi2) ** 2 + (t1 * t2 + 1.0 / t2 * t1) * torch.sin(phi1 - phi2) ** 2
+    # (N1, 1) against (1, N2) - implicit broadcasting instead of expanded copies
+    t1 = t1[:, None]
+    t2 = t2[None, :]
+    ratio = t1 / t2
+    # sin^2 = 1 - cos^2, i.e. a single transcendental per element
+    # NOTE precomputing cos/sin of the static center and data angles (cos(a - b) = cos a cos b + sin a sin b) was
+    # measured slower on CPU than the direct cos; vote evaluates every (center, data point) pair only once anyway
+    cos_2 = torch.cos(phi1[:, None] - phi2[None, :]) ** 2
+    dist = (ratio + 1.0 / ratio) * cos_2 + (t1 * t2 + ratio) * (1.0 - cos_2)
     dist = dist / 2
     return dist
 
 
+# (centers block x data chunk) elements per vote_counts step - keeps the intermediates in cache
+VOTE_COUNTS_CHUNK_ELEMENTS = 2 ** 16
+
+
+def vote_counts(centers, data, rhs):
+    """
+    Same as (distance_matrix_concise(centers, data) < rhs).sum(axis=1), but evaluated over tiles of the centers
+    and the data, so the full distances and votes matrices are never materialized
+    :param centers: torch.Tensor(2, C)
+    :param data: torch.Tensor(2, D)
+    :param rhs: float
+    :return: torch.Tensor(C) - number of data points within rhs for every center
+    """
+    # all the centers of the coverings in use fit in a single block, the data are then chunked to fill the tile
+    centers_block = max(1, min(centers.shape[1], VOTE_COUNTS_CHUNK_ELEMENTS))
+    chunk_size = max(1, VOTE_COUNTS_CHUNK_ELEMENTS // centers_block)
+    counts = torch.zeros(centers.shape[1], dtype=torch.long, device=centers.device)
+    for c_start in range(0, centers.shape[1], centers_block):
+        centers_tile = centers[:, c_start:c_start + centers_block]
+        counts_tile = counts[c_start:c_start + centers_block]
+        for start in range(0, data.shape[1], chunk_size):
+            counts_tile += (distance_matrix_concise(centers_tile, data[:, start:start + chunk_size]) < rhs).sum(axis=1)
+    return counts
+
+
 def distance_matrix_concise(centers, data):
     """
     :param centers:
@@ -160,13 +199,34 @@ def distance_matrix_concise(centers, data):
     return distance_matrix(t1, t2, phi1, phi2)
 
 
+def r_ball_distance(r_max):
+    """
+    The distance_matrix threshold of the ball with radius log(r_max), i.e. (exp(2r) + 1) / (2 exp(r)) evaluated
+    without the log/exp round trip
+    :param r_max: float
+    :return: float
+    """
+    return (r_max ** 2 + 1) / (2 * r_max)
+
+
 def draw_identity_data(ax, data, r):
     data_around_identity_mask = data[0] < r
     in_data = data[:, data_around_identity_mask]
     opt_conv_draw(ax, in_data, 'c', 0.5)
 
 
-def vote(covering_params, data, fraction_th, iter_th, conf, return_cover_idxs=False):
+def gather_winning_centers(centers, winners):
+    """
+    :param centers: torch.Tensor(2, C)
+    :param winners: list of the winning center indices
+    :return: torch.Tensor(W, 2) - rows (tau_i, phi_i), torch.tensor([]) if there is no winner
+    """
+    if len(winners) == 0:
+        return torch.tensor([])
+    return centers[:, winners].t().contiguous()
+
+
+def vote(covering_params, data, fraction_th, iter_th, conf, return_cover_idxs=False, device=None):
     """
     Assumes the data is prefiltered with e.g. sky mask. Data with t > t_max are
         a) marked with cover_idx == -4 if not covered (difference between all with t > t_max and those uncovered are
@@ -181,6 +241,8 @@ def vote(covering_params, data, fraction_th, iter_th, conf, return_cover_idxs=Fa
     :param iter_th:
     :param return_cover_idxs:
     :param conf:
+    :param device: where to run the voting iterations (elementwise + reductions over centers x data, i.e. worth
+                   it on the GPU for larger data); None - the device of data
     :return: winning_centers , cover_idx (=None return_cover_idxs == False)
         winning_centers: rows of with 2 columns - (tau_i, phi_i)
         cover_idx: index of centers for the data points
@@ -201,14 +263,7 @@ def vote(covering_params, data, fraction_th, iter_th, conf, return_cover_idxs=Fa
     Timer.start_check_point("vote_covering_centers")
     closest_winning_center = conf.get(CartesianConfig.sof_coverings_closest_winning_center, True)
 
-    r_ball_distance_new = (r_param ** 2 + 1) / (2 * r_param)
-
-    # TODO delete the following 4 lines of code
-    r_old = math.log(r_param)
-    r_ball_distance_old = (math.exp(2 * r_old) + 1) / (2 * math.exp(r_old))
-    # CONTINUE here + run & think about stats and visos
-    assert math.fabs(r_ball_distance_old - r_ball_distance_new) < 1.0e-10
-    assert math.exp(r_old) == r_param
+    r_ball_distance_new = r_ball_distance(r_param)
 
     # TODO effective_data_size - should be data and valid_px_mask and ~data_completely_off (but irrespective of data_around_identity_mask)
     data_completely_off = data[0] > t_max
@@ -227,32 +282,43 @@ def vote(covering_params, data, fraction_th, iter_th, conf, return_cover_idxs=Fa
         cover_idx[data_completely_off] = -4
         logging.debug("initial data points with t > t_max: {}".format(data_completely_off.sum()))
 
+    # moved just once, the cover_idx bookkeeping stays with data
+    # float64 data would promote the whole distance matrix, so they are voted in the dtype of the centers
+    centers_voting = centers if device is None else centers.to(device)
+    filtered_data = filtered_data.to(device=centers_voting.device, dtype=centers_voting.dtype)
+
+    # the covered data points are just masked out of filtered_data and their votes subtracted, i.e. every data
+    # point is voted on by all the centers only once
+    alive = torch.ones(filtered_data.shape[1], dtype=torch.bool, device=filtered_data.device)
+    alive_count = filtered_data.shape[1]
+    votes_count = vote_counts(centers_voting, filtered_data, r_ball_distance_new)
+
     iter_finished = 0
-    winning_centers = []
-    rect_fraction = 1 - filtered_data.shape[1] / init_data_size
+    # just the indices in the loop, the centers are gathered at once afterwards
+    winners = []
+    rect_fraction = 1 - alive_count / init_data_size
     while rect_fraction < fraction_th and iter_finished < iter_th:
 
-        distances = distance_matrix_concise(centers, filtered_data)
-        votes = (distances < r_ball_distance_new)
-        votes_count = votes.sum(axis=1)
-        sorted, indices = torch.sort(votes_count, descending=True)
-        data_in_mask = votes[indices[0]]
+        # only the top one is needed, no sort; a python int, so that it indexes tensors on any device
+        winner = int(torch.argmax(votes_count))
+        data_in_mask = (distance_matrix_concise(centers_voting[:, winner:winner + 1], filtered_data)[0] < r_ball_distance_new) & alive
 
         if return_cover_idxs and not closest_winning_center:
-            distances_all = distance_matrix_concise(centers[:, indices[0]:indices[0] + 1], data)
+            distances_all = distance_matrix_concise(centers[:, winner:winner + 1], data)
             votes_all = (distances_all < r_ball_distance_new)
             # & on bools?
             votes_new = votes_all[0] & (cover_idx == -1)
             cover_idx[votes_new] = iter_finished
 
-        filtered_data = filtered_data[:, ~data_in_mask]
-        rect_fraction = 1 - filtered_data.shape[1] / init_data_size
+        alive &= ~data_in_mask
+        alive_count -= int(data_in_mask.sum())
+        votes_count -= vote_counts(centers_voting, filtered_data[:, data_in_mask], r_ball_distance_new)
+        rect_fraction = 1 - alive_count / init_data_size
 
-        winning_center = centers[:, indices[0]]
-        winning_centers.append((winning_center[0].item(), winning_center[1].item()))
+        winners.append(winner)
         iter_finished += 1
 
-    winning_centers = torch.tensor(winning_centers)
+    winning_centers = gather_winning_centers(centers, winners)
 
     Timer.end_check_point("vote_covering_centers")
 
@@ -291,7 +357,7 @@ def opt_conv_draw_ellipses(ax, cov_params, centers, thickness=0.005, color="b"):
     # log_unit_radius_bigger = math.log(cov_params.r_max * 1.05)
     # log_unit_radius = math.log(cov_params.r_max)
     # rhs = (math.exp(2 * log_unit_radius) + 1) / (2 * math.exp(log_unit_radius))
-    rhs = (cov_params.r_max ** 2 + 1) / (2 * cov_params.r_max)
+    rhs = r_ball_distance(cov_params.r_max)
 
     factor = 1.4
     extend = factor * log_max_radius
@@ -380,8 +446,7 @@ def opt_cov_prepare_plot(cov_params: CoveringParams, title=None):
 
 
 def draw_covered_data(ax, center, data, r_max, color):
-    r_log = math.log(r_max)
-    rhs = (math.exp(2 * r_log) + 1) / (2 * math.exp(r_log))
+    rhs = r_ball_distance(r_max)
     distances = distance_matrix(center[0, None], data[0], center[1, None], data[1])
     votes = (distances[0] < rhs)
     data_in = data[:, votes]
@@ -721,14 +786,7 @@ def vote_old(centers, data, r_param, fraction_th, iter_th, return_cover_idxs=Fal
     if valid_px_mask is None:
         valid_px_mask = torch.ones(data.shape[1], dtype=torch.bool)
 
-    r_ball_distance_new = (r_param ** 2 + 1) / (2 * r_param)
-
-    # TODO delete the following 4 lines of code
-    r_old = math.log(r_param)
-    r_ball_distance_old = (math.exp(2 * r_old) + 1) / (2 * math.exp(r_old))
-    # CONTINUE here + run & think about stats and visos
-    assert math.fabs(r_ball_distance_old - r_ball_distance_new) < 1.0e-10
-    assert math.exp(r_old) == r_param
+    r_ball_distance_new = r_ball_distance(r_param)
 
     data_around_identity_mask = data[0] < r_param
 
@@ -746,37 +804,43 @@ def vote_old(centers, data, r_param, fraction_th, iter_th, return_cover_idxs=Fal
         valid_identity_filter = data_around_identity_mask & valid_px_mask
         cover_idx[valid_identity_filter] = -2
 
+    # see vote
+    alive = torch.ones(filtered_data.shape[1], dtype=torch.bool)
+    alive_count = filtered_data.shape[1]
+    votes_count = vote_counts(centers, filtered_data, r_ball_distance_new)
+
     iter_finished = 0
-    winning_centers = []
-    rect_fraction = 1 - filtered_data.shape[1] / data.shape[1]
+    # just the indices in the loop, the centers are gathered at once afterwards
+    winners = []
+    rect_fraction = 1 - alive_count / data.shape[1]
     while rect_fraction < fraction_th and iter_finished < iter_th:
 
-        distances = distance_matrix(centers[0], filtered_data[0], centers[1], filtered_data[1])
-        votes = (distances < r_ball_distance_new)
-        votes_count = votes.sum(axis=1)
-        sorted, indices = torch.sort(votes_count, descending=True)
+        # only the top one is needed, no sort
+        winner = int(torch.argmax(votes_count))
 
-        data_in_mask = votes[indices[0]]
+        data_in_mask = (distance_matrix_concise(centers[:, winner:winner + 1], filtered_data)[0] < r_ball_distance_new) & alive
         if return_cover_idxs:
-            distances_all = distance_matrix_concise(centers[:, indices[0]:indices[0] + 1], data)
+            distances_all = distance_matrix_concise(centers[:, winner:winner + 1], data)
             votes_all = (distances_all < r_ball_distance_new)
             # & on bools?
             votes_new = votes_all[0] & (cover_idx == -1)
             cover_idx[votes_new] = iter_finished
 
-        filtered_data = filtered_data[:, ~data_in_mask]
-        rect_fraction = 1 - filtered_data.shape[1] / data.shape[1]
+        alive &= ~data_in_mask
+        alive_count -= int(data_in_mask.sum())
+        votes_count -= vote_counts(centers, filtered_data[:, data_in_mask], r_ball_distance_new)
+        rect_fraction = 1 - alive_count / data.shape[1]
 
-        winning_center = centers[:, indices[0]]
-        winning_centers.append((winning_center[0].item(), winning_center[1].item()))
+        winners.append(winner)
         iter_finished += 1
 
     Timer.end_check_point("vote_covering_centers")
 
+    winning_centers = gather_winning_centers(centers, winners)
     if return_cover_idxs:
-        return torch.tensor(winning_centers), cover_idx
+        return winning_centers, cover_idx
     else:
-        return torch.tensor(winning_centers)
+        return winning_centers
 
 
 if __name__ == "__main__":
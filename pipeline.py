@@ -1,9 +1,13 @@
 #import sys
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 from hard_net_descriptor import HardNetDescriptor
 from normals_rotations import *
 from rootsift_descriptor import RootSIFT
+from kornia_sift_descriptor import KorniaSIFTDescriptor
 
 sys.path.append("./superpoint_forked")
 
@@ -50,6 +54,70 @@ def possibly_expand_normals(normals):
     return normals
 
 
+def parse_bool(v: str):
+    return v.lower() == "true"
+
+
+def parse_optional_int(v: str):
+    return None if v.lower() == "none" else int(v)
+
+
+def parse_device(v: str):
+    if v == "cpu":
+        return torch.device("cpu")
+    elif v == "cuda":
+        return torch.device("cuda")
+    else:
+        raise Exception("Unknown param value for 'device': {}".format(v))
+
+
+def parse_connectivity(v: str):
+    value = int(v)
+    assert value == 4 or value == 8, "connected_components_connectivity must be 4 or 8"
+    return value
+
+
+# config key (= Pipeline attribute) => parser of the value - see Pipeline.configure
+PIPELINE_ATTRS_PARSERS = {
+    "device": parse_device,
+    "method": str,
+    "file_name_suffix": str,
+    "use_degensac": parse_bool,
+    "estimate_k": parse_bool,
+    "focal_point_mean_factor": float,
+    "knn_ratio_threshold": float,
+    "matching_limit": int,
+    "planes_based_matching": parse_bool,
+    "output_dir": str,
+    "show_input_img": parse_bool,
+    "show_matching": parse_bool,
+    "save_matching": parse_bool,
+    "show_clusters": parse_bool,
+    "save_clusters": parse_bool,
+    "show_clustered_components": parse_bool,
+    "save_clustered_components": parse_bool,
+    "show_rectification": parse_bool,
+    "save_rectification": parse_bool,
+    "show_sky_mask": parse_bool,
+    "save_sky_mask": parse_bool,
+    "matching_pairs": parse_list,
+    "chosen_depth_files": parse_list,
+    "use_cached_img_data": parse_bool,
+    "img_processing_workers": int,
+    "max_cached_images": int,
+    "img_batch_size": int,
+    "output_dir_prefix": str,
+    "ransac_th": float,
+    "ransac_conf": float,
+    "ransac_iters": int,
+    "upsample_early": parse_bool,
+    "clip_angle": parse_optional_int,
+    "connected_components_connectivity": parse_connectivity,
+    "connected_components_closing_size": parse_optional_int,
+    "connected_components_flood_fill": parse_bool,
+}
+
+
 PROCESSING_IMG_FROM_SCRATCH_TAG = "processing_img_from_scratch"
 COMPLETE_IMAGE_PAIR_MATCHING_TAG = "complete_image_pair_matching"
 
@@ -117,6 +185,15 @@ class Pipeline:
 
     use_cached_img_data = True
 
+    # > 0: the images of a difficulty are processed into the img data cache in a process pool upfront
+    img_processing_workers = 0
+
+    # the img data cache is also kept in memory (LRU) for this many images, see get_memory_cached_image_data_or_none
+    max_cached_images = 32
+
+    # images per batch in batch_process_unrectified_images
+    img_batch_size = 8
+
     upsample_early = True
 
     # connected components
@@ -127,8 +204,42 @@ class Pipeline:
     def setup_descriptor(self):
         self.feature_descriptor = Pipeline.setup_descriptor_static(self.config, self.device)
 
+    def setup_models(self):
+        self.setup_descriptor()
+        if self.config[CartesianConfig.affnet_clustering]:
+            self.dense_affnet = DenseAffNet(True, self.device)
+
+    def setup_clustering(self):
+        Clustering.angle_distance_threshold_degrees = self.config["angle_distance_threshold_degrees"]
+        Clustering.recompute(math.sqrt(self.config["singular_value_quantil"]))
+
+    # set up in start() (or in init_img_processing_worker), i.e. not a part of the settings
+    runtime_attrs = ["scene_info", "depth_reader", "feature_descriptor", "dense_affnet", "stats", "stats_map", "img_data_memory_cache"]
+
+    def get_settings(self):
+        """
+        :return: the configured attributes (incl. config and cache_map) without the runtime state (see runtime_attrs)
+        """
+        return {k: v for k, v in vars(self).items() if k not in Pipeline.runtime_attrs}
+
+    @staticmethod
+    def from_settings(settings):
+        pipeline = Pipeline()
+        for k, v in settings.items():
+            setattr(pipeline, k, v)
+        return pipeline
+
+    def read_scene_info(self):
+        self.scene_info = SceneInfo.read_scene(scene_name=self.config["scene_name"], type=self.config["scene_type"], file_name_suffix=self.file_name_suffix)
+        self.depth_reader = DepthReader(self.scene_info.depth_input_dir())
+
     @staticmethod
     def setup_descriptor_static(config, device=torch.device("cpu")):
+        """
+        Creates just the configured descriptor, when the pipeline starts (i.e. not when the config is read). The
+        instance is not to be shared across threads (the OpenCV detectors keep mutable state) - the img processing
+        workers create their own (see init_img_processing_worker), it's never pickled.
+        """
         feature_descriptor = config["feature_descriptor"]
         n_features = config["n_features"]
         sift_octave_layers = config["sift_octave_layers"]
@@ -138,13 +249,16 @@ class Pipeline:
 
         if feature_descriptor == "SIFT":
             feature_descriptor = cv.SIFT_create(n_features, sift_octave_layers, sift_contrast_threshold, sift_edge_threshold, sift_sigma)
+        elif feature_descriptor == "KORNIA_SIFT":
+            # SIFT on the device, the modules are kept for all the images
+            feature_descriptor = KorniaSIFTDescriptor(n_features, device=device)
         elif feature_descriptor == "BRISK":
             feature_descriptor = cv.BRISK_create(n_features)
         elif feature_descriptor == "SUPERPOINT":
             feature_descriptor = SuperPointDescriptor(path="./superpoint_forked/superpoint_v1.pth", device=device)
         elif feature_descriptor == "ROOT_SIFT":
             feature_descriptor = cv.SIFT_create(n_features, sift_octave_layers, sift_contrast_threshold, sift_edge_threshold, sift_sigma)
-            feature_descriptor = RootSIFT(feature_descriptor)
+            feature_descriptor = RootSIFT(feature_descriptor, quantize=config["root_sift_uint8"])
         elif feature_descriptor == "HARD_NET":
             affnet_hard_net_filter = config.get("affnet_hard_net_filter", None)
             affnet_compute_laffs = config.get("affnet_compute_laffs", False)
@@ -178,91 +292,14 @@ class Pipeline:
                 k = k.strip()
                 v = v.strip()
 
-                if k == "device":
-                    if v == "cpu":
-                        pipeline.device = torch.device("cpu")
-                    elif v == "cuda":
-                        pipeline.device = torch.device("cuda")
-                    else:
-                        raise Exception("Unknown param value for 'device': {}".format(v))
-                elif k == "method":
-                    pipeline.method = v
-                elif k == "file_name_suffix":
-                    pipeline.file_name_suffix = v
-                elif k == "use_degensac":
-                    pipeline.use_degensac = v.lower() == "true"
-                elif k == "estimate_k":
-                    pipeline.estimate_k = v.lower() == "true"
-                elif k == "focal_point_mean_factor":
-                    pipeline.focal_point_mean_factor = float(v)
-                elif k == "knn_ratio_threshold":
-                    pipeline.knn_ratio_threshold = float(v)
-                elif k == "matching_difficulties_min":
+                if k == "matching_difficulties_min":
                     matching_difficulties_min = int(v)
                 elif k == "matching_difficulties_max":
                     matching_difficulties_max = int(v)
-                elif k == "matching_limit":
-                    pipeline.matching_limit = int(v)
-                elif k == "planes_based_matching":
-                    pipeline.planes_based_matching = v.lower() == "true"
-                elif k == "output_dir":
-                    pipeline.output_dir = v
-                elif k == "show_input_img":
-                    pipeline.show_input_img = v.lower() == "true"
-                elif k == "show_matching":
-                    pipeline.show_matching = v.lower() == "true"
-                elif k == "save_matching":
-                    pipeline.save_matching = v.lower() == "true"
-                elif k == "show_clusters":
-                    pipeline.show_clusters = v.lower() == "true"
-                elif k == "save_clusters":
-                    pipeline.save_clusters = v.lower() == "true"
-                elif k == "show_clustered_components":
-                    pipeline.show_clustered_components = v.lower() == "true"
-                elif k == "save_clustered_components":
-                    pipeline.save_clustered_components = v.lower() == "true"
-                elif k == "show_rectification":
-                    pipeline.show_rectification = v.lower() == "true"
-                elif k == "save_rectification":
-                    pipeline.save_rectification = v.lower() == "true"
-                elif k == "show_sky_mask":
-                    pipeline.show_sky_mask = v.lower() == "true"
-                elif k == "save_sky_mask":
-                    pipeline.save_sky_mask = v.lower() == "true"
                 elif k == "do_flann":
-                    Config.config_map[Config.key_do_flann] = v.lower() == "true"
-                elif k == "matching_pairs":
-                    pipeline.matching_pairs = parse_list(v)
-                elif k == "chosen_depth_files":
-                    pipeline.chosen_depth_files = parse_list(v)
-                elif k == "use_cached_img_data":
-                    pipeline.use_cached_img_data = v.lower() == "true"
-                elif k == "output_dir_prefix":
-                    pipeline.output_dir_prefix = v
-                elif k == "ransac_th":
-                    pipeline.ransac_th = float(v)
-                elif k == "ransac_conf":
-                    pipeline.ransac_conf = float(v)
-                elif k == "ransac_iters":
-                    pipeline.ransac_iters = int(v)
-                elif k == "upsample_early":
-                    pipeline.upsample_early = v.lower() == "true"
-                elif k == "clip_angle":
-                    if v.lower() == "none":
-                        pipeline.clip_angle = None
-                    else:
-                        pipeline.clip_angle = int(v)
-                elif k == "connected_components_connectivity":
-                    value = int(v)
-                    assert value == 4 or value == 8, "connected_components_connectivity must be 4 or 8"
-                    pipeline.connected_components_connectivity = value
-                elif k == "connected_components_closing_size":
-                    if v.lower() == "none":
-                        pipeline.connected_components_closing_size = None
-                    else:
-                        pipeline.connected_components_closing_size = int(v)
-                elif k == "connected_components_flood_fill":
-                    pipeline.connected_components_flood_fill = v.lower() == "true"
+                    Config.config_map[Config.key_do_flann] = parse_bool(v)
+                elif k in PIPELINE_ATTRS_PARSERS:
+                    setattr(pipeline, k, PIPELINE_ATTRS_PARSERS[k](v))
                 else:
                     CartesianConfig.config_parse_line(k, v, config)
 
@@ -282,14 +319,14 @@ class Pipeline:
         print("is torch.cuda.is_available(): {}".format(torch.cuda.is_available()))
         print("device: {}".format(self.device))
 
-        Clustering.angle_distance_threshold_degrees = self.config["angle_distance_threshold_degrees"]
-        Clustering.recompute(math.sqrt(self.config["singular_value_quantil"]))
+        self.setup_clustering()
+        # the cached img data depend on the config
+        self.img_data_memory_cache = OrderedDict()
 
         self.log()
-        self.scene_info = SceneInfo.read_scene(scene_name=self.config["scene_name"], type=self.config["scene_type"], file_name_suffix=self.file_name_suffix)
-        self.setup_descriptor()
+        self.read_scene_info()
+        self.setup_models()
         if self.config[CartesianConfig.affnet_clustering]:
-            self.dense_affnet = DenseAffNet(True, self.device)
             assert self.config["rectify_affine_affnet"], "'affnet_clustering' without 'rectify_affine_affnet' doesn't work"
 
         if self.config["rectify_affine_affnet"]:
@@ -300,18 +337,22 @@ class Pipeline:
         if self.matching_pairs is not None:
             self.matching_difficulties = scene_length_range
 
-        self.depth_reader = DepthReader(self.scene_info.depth_input_dir())
-
         intersection = set(self.matching_difficulties).intersection(set(scene_length_range))
         self.matching_difficulties = list(intersection)
 
+    # not config or too big to be logged
+    not_logged_attrs = ["not_logged_attrs", "runtime_attrs", "stats", "stats_map", "scene_info", "img_data_memory_cache"]
+
     def log(self):
         print("Pipeline config:")
-        attr_list = [attr for attr in dir(self) if not callable(getattr(self, attr)) and not attr.startswith("__") and attr not in ["stats", "stats_map"]]
-        for attr_name in attr_list:
-            if attr_name in ["scene_info"]:
+        # the attributes are just the class level ones (the defaults) and the instance ones - no need for dir()
+        attr_names = sorted(set(vars(Pipeline)) | set(vars(self)))
+        for attr_name in attr_names:
+            if attr_name.startswith("__") or attr_name in Pipeline.not_logged_attrs:
                 continue
-            print("\t{}\t{}".format(attr_name, getattr(self, attr_name)))
+            value = getattr(self, attr_name)
+            if not callable(value):
+                print("\t{}\t{}".format(attr_name, value))
         print()
 
         Config.log()
@@ -326,11 +367,14 @@ class Pipeline:
             Path(img_processing_dir).mkdir(parents=True, exist_ok=True)
         return img_processing_dir
 
+    def get_img_data_path(self, img_name):
+        return "{}/{}_img_data.pkl".format(self.get_img_processing_dir(), img_name)
+
     def get_cached_image_data_or_none(self, img_name, img, real_K):
 
         Timer.start_check_point("Serving img data from cache")
-        img_processing_dir = self.get_and_create_img_processing_dir()
-        img_data_path = "{}/{}_img_data.pkl".format(img_processing_dir, img_name)
+        self.get_and_create_img_processing_dir()
+        img_data_path = self.get_img_data_path(img_name)
         if self.use_cached_img_data and os.path.isfile(img_data_path):
             Timer.start_check_point("reading img processing data")
             with open(img_data_path, "rb") as f:
@@ -345,12 +389,51 @@ class Pipeline:
         Timer.end_check_point("Serving img data from cache")
         return ret
 
+    def get_memory_cached_image_data_or_none(self, img_name):
+        """
+        The images repeat across the pairs, this serves them without reading the image and unpickling the img data
+        again. The img data are rebuilt from the serialized data exactly as from the img data cache on disk, so the
+        callers are free to reassign the fields (e.g. rectify_by_fixed_rotation_update).
+        """
+        if not self.use_cached_img_data:
+            return None
+        entry = self.img_data_memory_cache.get(img_name)
+        if entry is None:
+            return None
+        self.img_data_memory_cache.move_to_end(img_name)
+        img, real_K, img_serialized_data = entry
+        print("img data for {} served from memory".format(img_name))
+        return ImageData.from_serialized_data(img=img, real_K=real_K, img_serialized_data=img_serialized_data)
+
+    def memory_cache_img_data(self, img_name, img_data):
+        if not self.use_cached_img_data or self.max_cached_images <= 0:
+            return
+        self.img_data_memory_cache[img_name] = (img_data.img, img_data.real_K, img_data.to_serialized_data())
+        self.img_data_memory_cache.move_to_end(img_name)
+        if len(self.img_data_memory_cache) > self.max_cached_images:
+            self.img_data_memory_cache.popitem(last=False)
+
+    @staticmethod
+    def create_unrectified_img_data(img, real_K, kps, descs):
+        for kp in kps:
+            kp.response = 1 * kp.response
+            kp.size = 5 * kp.size
+
+        return ImageData(img=img,
+                         real_K=real_K,
+                         key_points=kps,
+                         descriptions=descs,
+                         normals=None,
+                         ts_phis=None,
+                         components_indices=None,
+                         valid_components_dict=None)
+
     @staticmethod
     def save_img_data(img_data, img_data_path, img_name):
         Timer.start_check_point("saving img data")
         with open(img_data_path, "wb") as f:
             print("img data for {} saving into: {}".format(img_name, img_data_path))
-            pickle.dump(img_data.to_serialized_data(), f)
+            pickle.dump(img_data.to_serialized_data(), f, protocol=pickle.HIGHEST_PROTOCOL)
         Timer.end_check_point("saving img data")
 
     def read_img(self, img_name):
@@ -433,17 +516,13 @@ class Pipeline:
     @timer_label_decorator()
     def filter_valid_normals(self, normals):
         # LAST_MINUTE !!!
-        valid_normal_indices = []
-        for i, normal in enumerate(normals):
-            angle_rad = math.acos(np.dot(normal, np.array([0, 0, -1])))
-            angle_degrees = angle_rad * 180 / math.pi
-            # print("angle: {} vs. angle threshold: {}".format(angle_degrees, Config.plane_threshold_degrees))
-            if angle_degrees >= Config.plane_threshold_degrees:
-                print("WARNING: too sharp of an angle with the -z axis, skipping the rectification")
-                continue
-            else:
-                print("angle ok")
-                valid_normal_indices.append(i)
+        # the dot product with [0, 0, -1] is just -z
+        cos_angles = np.clip(-np.asarray(normals).reshape(-1, 3)[:, 2], -1.0, 1.0)
+        angles_degrees = np.degrees(np.arccos(cos_angles))
+        # print("angles: {} vs. angle threshold: {}".format(angles_degrees, Config.plane_threshold_degrees))
+        valid_normal_indices = np.flatnonzero(angles_degrees < Config.plane_threshold_degrees).tolist()
+        for _ in range(len(angles_degrees) - len(valid_normal_indices)):
+            print("WARNING: too sharp of an angle with the -z axis, skipping the rectification")
 
         return valid_normal_indices
 
@@ -460,6 +539,10 @@ class Pipeline:
     def process_image(self, img_name, order):
 
         print("Processing: {}".format(img_name))
+        memory_cached_img_data = self.get_memory_cached_image_data_or_none(img_name)
+        if memory_cached_img_data is not None:
+            return memory_cached_img_data
+
         img_processing_dir = self.get_and_create_img_processing_dir()
         Path(img_processing_dir).mkdir(parents=True, exist_ok=True)
 
@@ -479,9 +562,10 @@ class Pipeline:
             K_for_rectification = real_K
             focal_length = real_K[0, 0]
 
-        img_data_path = "{}/{}_img_data.pkl".format(img_processing_dir, img_name)
+        img_data_path = self.get_img_data_path(img_name)
         cached_img_data = self.get_cached_image_data_or_none(img_name, img, real_K)
         if cached_img_data is not None:
+            self.memory_cache_img_data(img_name, cached_img_data)
             return cached_img_data
 
         self.possibly_set_custom_normals(img_name, focal_length, orig_height, orig_width, real_K)
@@ -493,10 +577,6 @@ class Pipeline:
 
             kps, descs = self.feature_descriptor.detectAndCompute(img, None)
 
-            for kp in kps:
-                kp.response = 1 * kp.response
-                kp.size = 5 * kp.size
-
             ## NOTE: to visualize kpts without rectification
 
             # import torch.nn as nn
@@ -522,16 +602,10 @@ class Pipeline:
             # plt.savefig("work/keypoints_new.png", bbox_inches='tight', pad_inches=0)
             # plt.show()
 
-            img_data = ImageData(img=img,
-                             real_K=real_K,
-                             key_points=kps,
-                             descriptions=descs,
-                             normals=None,
-                             ts_phis=None,
-                             components_indices=None,
-                             valid_components_dict=None)
+            img_data = Pipeline.create_unrectified_img_data(img, real_K, kps, descs)
 
             Pipeline.save_img_data(img_data, img_data_path, img_name)
+            self.memory_cache_img_data(img_name, img_data)
 
             Timer.end_check_point("processing img without rectification")
             return img_data
@@ -671,6 +745,7 @@ class Pipeline:
             Timer.end_check_point(PROCESSING_IMG_FROM_SCRATCH_TAG)
 
             Pipeline.save_img_data(img_data, img_data_path, img_name)
+            self.memory_cache_img_data(img_name, img_data)
 
             return img_data
 
@@ -1186,6 +1261,89 @@ class Pipeline:
                 return True
         return False
 
+    def get_pairs_to_match(self, difficulty):
+        pairs = []
+        for img_pair in self.scene_info.img_pairs_lists[difficulty]:
+            pair_key = SceneInfo.get_key(img_pair.img1, img_pair.img2)
+            if self.matching_pairs is not None and pair_key not in self.matching_pairs:
+                continue
+            if self.matching_pairs is None and self.matching_limit is not None and len(pairs) >= self.matching_limit:
+                break
+            pairs.append(img_pair)
+        return pairs
+
+    def get_uncached_img_names_orders(self, img_pairs):
+        """
+        :param img_pairs: list of ImagePairEntry
+        :return: list of (img_name, order) of the images not in the img data cache, the order (rotation_alpha1/2) is
+                 the one of the first occurrence - as the image would be processed sequentially
+        """
+        img_orders = {}
+        for img_pair in img_pairs:
+            for order, img_name in enumerate([img_pair.img1, img_pair.img2]):
+                img_orders.setdefault(img_name, order)
+        return [(img_name, order) for img_name, order in img_orders.items() if not os.path.isfile(self.get_img_data_path(img_name))]
+
+    def batch_process_unrectified_images(self, img_pairs):
+        """
+        Without rectification the img data are just the key points and descriptions of the whole image. With
+        KorniaSIFTDescriptor the images of img_pairs not in the img data cache yet are therefore detected in batches
+        (of img_batch_size) on the device and put into the cache, process_image then just serves them from the cache.
+        :param img_pairs: list of ImagePairEntry
+        """
+        if self.config[CartesianConfig.rectify] or not self.use_cached_img_data or not isinstance(self.feature_descriptor, KorniaSIFTDescriptor):
+            return
+
+        img_names = [img_name for img_name, _ in self.get_uncached_img_names_orders(img_pairs)]
+        self.get_and_create_img_processing_dir()
+        for start in range(0, len(img_names), self.img_batch_size):
+            batch_names = img_names[start:start + self.img_batch_size]
+            try:
+                Timer.start_check_point("processing img batch without rectification")
+                imgs = [self.read_img(img_name) for img_name in batch_names]
+                kps_descs_list = self.feature_descriptor.detectAndCompute_batch(imgs)
+                for img_name, img, (kps, descs) in zip(batch_names, imgs, kps_descs_list):
+                    real_K = self.scene_info.get_img_K(img_name, img)
+                    img_data = Pipeline.create_unrectified_img_data(img, real_K, kps, descs)
+                    Pipeline.save_img_data(img_data, self.get_img_data_path(img_name), img_name)
+                    self.memory_cache_img_data(img_name, img_data)
+                Timer.end_check_point("processing img batch without rectification")
+            except:
+                # will be processed (and possibly skipped) one by one in the matching loop
+                print("(processing img batch) {} couldn't be processed".format(", ".join(batch_names)))
+                print(traceback.format_exc(), file=sys.stdout)
+
+    def prefetch_img_data(self, img_pairs):
+        """
+        Processes the images of img_pairs which are not in the img data cache yet in a process pool, so that
+        process_image then just serves them from the cache. The images are independent, but the processing is
+        CPU bound, hence processes and not threads. The workers are set up just once from the settings (see
+        init_img_processing_worker), then only the img names are sent to them. The timer stats of the workers are not
+        collected.
+        :param img_pairs: list of ImagePairEntry
+        """
+        if self.img_processing_workers <= 0 or not self.use_cached_img_data:
+            return
+
+        to_process = self.get_uncached_img_names_orders(img_pairs)
+        if len(to_process) == 0:
+            return
+
+        print("processing {} images in {} workers".format(len(to_process), self.img_processing_workers))
+        # spawn - a forked CUDA context is not usable in the children
+        mp_context = multiprocessing.get_context("spawn")
+        init_args = (self.get_settings(), Config.config_map, SceneInfo.base_dir)
+        with ProcessPoolExecutor(max_workers=self.img_processing_workers, mp_context=mp_context,
+                                 initializer=init_img_processing_worker, initargs=init_args) as executor:
+            futures = [(img_name, executor.submit(process_image_in_worker, img_name, order)) for img_name, order in to_process]
+            for img_name, future in futures:
+                try:
+                    merge_stats_map_static(future.result(), self.stats)
+                except:
+                    # will be processed (and possibly skipped) again in the matching loop
+                    print("(processing image in a worker) {} couldn't be processed".format(img_name))
+                    print(traceback.format_exc(), file=sys.stdout)
+
     def run_matching_pipeline(self):
 
         self.start()
@@ -1200,6 +1358,10 @@ class Pipeline:
             stats_map_diff = {}
             self.stats_map[self.get_stats_key()][difficulty] = stats_map_diff
 
+            pairs_to_match = self.get_pairs_to_match(difficulty)
+            self.batch_process_unrectified_images(pairs_to_match)
+            self.prefetch_img_data(pairs_to_match)
+
             processed_pairs = 0
             for img_pair in self.scene_info.img_pairs_lists[difficulty]:
 
@@ -1312,6 +1474,40 @@ class Pipeline:
             print(traceback.format_exc(), file=sys.stdout)
 
 
+# the pipeline of an img processing worker process (see init_img_processing_worker)
+worker_pipeline = None
+
+
+def init_img_processing_worker(settings, config_map, scene_base_dir):
+    """
+    Initializer of the img processing worker processes (see Pipeline.prefetch_img_data): the worker's pipeline is set
+    up from the settings of the main one, the scene info is read and the models are created just once per worker
+    :param settings: see Pipeline.get_settings
+    :param config_map: Config.config_map of the main process
+    :param scene_base_dir: SceneInfo.base_dir of the main process
+    """
+    global worker_pipeline
+    Config.config_map.update(config_map)
+    SceneInfo.base_dir = scene_base_dir
+    worker_pipeline = Pipeline.from_settings(settings)
+    worker_pipeline.setup_clustering()
+    worker_pipeline.read_scene_info()
+    worker_pipeline.setup_models()
+    # the img data are only read from the img data cache by the main process
+    worker_pipeline.max_cached_images = 0
+    worker_pipeline.img_data_memory_cache = OrderedDict()
+
+
+def process_image_in_worker(img_name, order):
+    """
+    See Pipeline.prefetch_img_data - the img data end up in the img data cache
+    :return: the stats collected while processing the image
+    """
+    worker_pipeline.stats = {}
+    worker_pipeline.process_image(img_name, order)
+    return worker_pipeline.stats
+
+
 def get_tmsp():
     now = datetime.now()
     return now.strftime("%Y_%m_%d_%H_%M_%S_%f")
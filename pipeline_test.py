@@ -0,0 +1,117 @@
+import pickle
+
+import cv2 as cv
+import numpy as np
+
+from config import CartesianConfig
+from evaluation import ImagePairEntry
+from pipeline import Pipeline
+from scene_info import SceneInfo
+
+SCENE_NAME = "scene1"
+IMG_NAMES = ["img1", "img2", "img3"]
+HEIGHT = 96
+WIDTH = 128
+
+
+def get_synthetic_img(seed):
+    rng = np.random.default_rng(seed)
+    img = np.full((HEIGHT, WIDTH, 3), 128, dtype=np.uint8)
+    for _ in range(60):
+        center = (int(rng.integers(0, WIDTH)), int(rng.integers(0, HEIGHT)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv.circle(img, center, int(rng.integers(2, 8)), color, thickness=-1)
+    return img
+
+
+def get_plane_depth(seed):
+    """
+    :return: depth map of a plane tilted around the y axis (i.e. there is a single normal to be clustered)
+    """
+    xs = np.linspace(-1.0, 1.0, WIDTH)[None].repeat(HEIGHT, axis=0)
+    return 10.0 / (1.0 - (0.2 + 0.1 * seed) * xs)
+
+
+def write_scene(base_dir):
+    """
+    Writes a tiny 'orig' scene (see SceneInfo.read_scene): images, cameras, image pairs and depth maps
+    """
+    scene_dir = base_dir / "original_dataset" / SCENE_NAME
+    (scene_dir / "0").mkdir(parents=True)
+    (scene_dir / "images").mkdir()
+    depth_dir = base_dir / "depth_data" / "mega_depth" / SCENE_NAME
+    depth_dir.mkdir(parents=True)
+
+    with open(scene_dir / "0" / "cameras.txt", "w") as f:
+        f.write("1 PINHOLE {} {} 100.0 {} {} 0.0\n".format(WIDTH, HEIGHT, WIDTH // 2, HEIGHT // 2))
+    with open(scene_dir / "0" / "images.txt", "w") as f:
+        for i, img_name in enumerate(IMG_NAMES):
+            f.write("{} 1.0 0.0 0.0 0.0 0.0 0.0 {} 1 {}.jpg\n".format(i + 1, float(i), img_name))
+            f.write("\n")
+    with open(scene_dir / "{}_image_pairs.txt".format(SCENE_NAME), "w") as f:
+        f.write("img1.jpg img2.jpg 0\n")
+        f.write("img2.jpg img3.jpg 0\n")
+
+    for i, img_name in enumerate(IMG_NAMES):
+        cv.imwrite(str(scene_dir / "images" / "{}.jpg".format(img_name)), get_synthetic_img(i))
+        np.save(str(depth_dir / "{}.npy".format(img_name)), get_plane_depth(i))
+
+
+def get_started_pipeline(tmp_path, output_dir, img_processing_workers):
+    config_file_name = tmp_path / "{}_config.txt".format(output_dir)
+    with open(config_file_name, "w") as f:
+        f.write("\n".join([
+            "scene_name = {}".format(SCENE_NAME),
+            "scene_type = orig",
+            "file_name_suffix = .jpg",
+            "matching_difficulties_min = 0",
+            "matching_difficulties_max = 1",
+            "rectify = True",
+            "filter_sky = False",
+            "singular_value_quantil = 0.9",
+            "feature_descriptor = SIFT",
+            "output_dir = {}".format(tmp_path / output_dir),
+            "img_processing_workers = {}".format(img_processing_workers),
+        ] + ["{} = False".format(key) for key in ["show_input_img", "show_matching", "save_matching", "show_clusters",
+                                                  "save_clusters", "show_clustered_components",
+                                                  "save_clustered_components", "show_rectification",
+                                                  "save_rectification", "show_sky_mask", "save_sky_mask"]]))
+
+    pipeline, config_map = Pipeline.configure(str(config_file_name), None)
+    pipeline.config, pipeline.cache_map = CartesianConfig.get_configs(config_map)[0]
+    pipeline.stats = {}
+    pipeline.start()
+    return pipeline
+
+
+def read_img_data(pipeline, img_name):
+    with open(pipeline.get_img_data_path(img_name), "rb") as f:
+        return pickle.load(f)
+
+
+def test_prefetch_img_data_same_as_sequential(tmp_path, monkeypatch):
+    write_scene(tmp_path)
+    monkeypatch.setattr(SceneInfo, "base_dir", str(tmp_path))
+    img_pairs = [ImagePairEntry("img1", "img2", 0), ImagePairEntry("img2", "img3", 0)]
+
+    sequential = get_started_pipeline(tmp_path, "sequential", img_processing_workers=0)
+    for img_name in IMG_NAMES:
+        sequential.process_image(img_name, 0)
+
+    prefetched = get_started_pipeline(tmp_path, "prefetched", img_processing_workers=2)
+    prefetched.prefetch_img_data(img_pairs)
+
+    # the img data were computed by the workers, there is nothing in the memory cache of the main process
+    assert len(prefetched.img_data_memory_cache) == 0
+    assert len(sequential.stats) > 0
+    assert prefetched.stats.keys() == sequential.stats.keys()
+    np.testing.assert_equal(prefetched.stats, sequential.stats)
+    for img_name in IMG_NAMES:
+        expected = read_img_data(sequential, img_name)
+        actual = read_img_data(prefetched, img_name)
+        assert len(expected.kpts) > 0
+        assert [kp.pt for kp in actual.kpts] == [kp.pt for kp in expected.kpts]
+        np.testing.assert_equal(actual.descs, expected.descs)
+        np.testing.assert_equal(actual.normals, expected.normals)
+        np.testing.assert_equal(actual.components_indices, expected.components_indices)
+        assert actual.valid_components_dict == expected.valid_components_dict
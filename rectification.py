@@ -11,7 +11,7 @@ from connected_components import get_and_show_components, read_img_normals_info,
 from img_utils import show_or_close
 from resize import resample_nearest_numpy
 from scene_info import SceneInfo
-from utils import Timer, identity_map_from_range_of_iter, get_rotation_matrix, get_rotation_matrix_safe, timer_label_decorator, append_update_stats_map_static
+from utils import Timer, identity_map_from_range_of_iter, get_rotation_matrix, get_rotation_matrix_safe, timer_label_decorator, append_update_stats_map_static, get_K_inv, kps_to_xy
 
 
 def get_rectification_rotation(normal, rotation_factor=1.0):
@@ -150,7 +150,7 @@ def get_rectified_keypoints(normals,
                             stats_map=None,
                             ):
 
-    K_inv = np.linalg.inv(K)
+    K_inv = get_K_inv(K)
 
     all_descs = None
     all_kps = []
@@ -186,7 +186,7 @@ def get_rectified_keypoints(normals,
 
         kps, descs = descriptor.detectAndCompute(rectified, None)
 
-        kps_raw = np.float32([kp.pt for kp in kps]).reshape(-1, 1, 2)
+        kps_raw = kps_to_xy(kps).reshape(-1, 1, 2)
 
         new_kps = cv.perspectiveTransform(kps_raw, T_inv)
 
@@ -218,7 +218,9 @@ def get_rectified_keypoints(normals,
 
             kps = [kp for i, kp in enumerate(kps) if cluster_mask_bool[i]]
 
-            cv.drawKeypoints(rectified, kps, rectified, flags=cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+            # only for the visualization below
+            if show or save:
+                cv.drawKeypoints(rectified, kps, rectified, flags=cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
 
             for kpi, kp in enumerate(kps):
                 kp.pt = tuple(new_kps[kpi, 0].tolist())
@@ -259,7 +261,7 @@ def get_rectified_keypoints(normals,
 
     if not all_unrectified:
 
-        kps_floats = np.float32([kp.pt for kp in kps])
+        kps_floats = kps_to_xy(kps)
         # TODO is this the way to round it?
         kps_ints = np.int32(kps_floats)
         in_img_mask = kps_ints[:, 0] >= 0
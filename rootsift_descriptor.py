@@ -3,9 +3,16 @@ import numpy as np
 
 class RootSIFT:
 
-    def __init__(self, descriptor, eps=1e-7):
+    def __init__(self, descriptor, eps=1e-7, quantize=False):
+        """
+        :param descriptor: e.g. cv.SIFT
+        :param eps:
+        :param quantize: the descriptors as uint8 (x512, clipped) - a quarter of the memory and disk footprint of
+                         float32 (see find_correspondences for the matching)
+        """
         self.eps = eps
         self.descriptor = descriptor
+        self.quantize = quantize
 
     def detect(self, img, positions=None):
         assert positions is None
@@ -16,7 +23,12 @@ class RootSIFT:
         if len(kps) == 0:
             return [], None
 
+        # in place - no temporaries of the size of descs
         descs /= (descs.sum(axis=1, keepdims=True) + self.eps)
-        descs = np.sqrt(descs)
+        np.sqrt(descs, out=descs)
+        if self.quantize:
+            # the components are <= 1 (their squares sum up to 1), in practice well below 0.5
+            descs *= 512
+            np.clip(descs, 0, 255, out=descs)
+            descs = descs.astype(np.uint8)
         return kps, descs
-
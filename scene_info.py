@@ -5,7 +5,7 @@ import h5py
 import os
 
 from dataclasses import dataclass
-from utils import Timer, quaternions_to_R
+from utils import Timer, quaternions_to_R, get_K_inv, vector_product_matrix
 from img_utils import show_or_close
 
 
@@ -175,6 +175,14 @@ class SceneInfo:
         return '{}/{}{}'.format(self.get_input_dir(), img_name, self.file_name_suffix)
 
     def get_img_K(self, img_name, img):
+        """
+        :return: K scaled to img - cached per (img_name, img size), as images appear in many pairs
+        """
+        K_cache = self.__dict__.setdefault("K_cache", {})
+        key = (img_name, img.shape[0], img.shape[1])
+        if key in K_cache:
+            return K_cache[key]
+
         img_entry = self.img_info_map[img_name]
         if img_entry.K is not None:
             K_to_scale = img_entry.K
@@ -184,8 +192,36 @@ class SceneInfo:
         K_to_scale[:2, :] *= img.shape[1] / (K_to_scale[0, 2] * 2.0)
         assert abs(K_to_scale[0, 2] * 2 - img.shape[1]) < 1.0
         assert abs(K_to_scale[1, 2] * 2 - img.shape[0]) < 1.0
+        K_cache[key] = K_to_scale
         return K_to_scale
 
+    def get_img_K_inv(self, img_name, img):
+        """
+        :return: inverse of get_img_K(img_name, img) - closed form (see get_K_inv), cached as well
+        """
+        K_inv_cache = self.__dict__.setdefault("K_inv_cache", {})
+        key = (img_name, img.shape[0], img.shape[1])
+        if key not in K_inv_cache:
+            K_inv_cache[key] = get_K_inv(self.get_img_K(img_name, img))
+        return K_inv_cache[key]
+
+    def get_F_ground_truth(self, img1_name, img1, img2_name, img2):
+        """
+        :return: ground truth fundamental matrix of the pair from the poses and get_img_K_inv - it doesn't depend
+        on the matches, so it is cached per (img1_name, img1 size, img2_name, img2 size)
+        """
+        F_gt_cache = self.__dict__.setdefault("F_gt_cache", {})
+        key = (img1_name, img1.shape[0], img1.shape[1], img2_name, img2.shape[0], img2.shape[1])
+        if key not in F_gt_cache:
+            img_entry_1 = self.img_info_map[img1_name]
+            img_entry_2 = self.img_info_map[img2_name]
+            T1, R1 = np.array(img_entry_1.t), img_entry_1.R
+            T2, R2 = np.array(img_entry_2.t), img_entry_2.R
+            K1_inv = self.get_img_K_inv(img1_name, img1)
+            K2_inv = self.get_img_K_inv(img2_name, img2)
+            F_gt_cache[key] = K2_inv.T @ R2 @ vector_product_matrix(T2 - T1) @ R1.T @ K1_inv
+        return F_gt_cache[key]
+
     def depth_input_dir(self):
         if self.type == "orig":
             return "{}/depth_data/mega_depth/{}".format(SceneInfo.base_dir, self.name)
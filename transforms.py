@@ -6,48 +6,57 @@ def get_rotation_matrices_torch(unit_rotation_vectors, angs_rads, device):
     """
     :param unit_rotation_vectors:
     :param angs_rads:
+    :param device: unused - R is created on the device (and with the dtype) of unit_rotation_vectors
     :return:
     """
 
     # Rodrigues formula
     # R = I + sin(theta) . K + (1 - cos(theta)).K**2
+    #   = cos(theta) . I + sin(theta) . K + (1 - cos(theta)) . v @ v^T  (as K**2 = v @ v^T - I for a unit v)
+
+    xs, ys, zs = unit_rotation_vectors[:, 0], unit_rotation_vectors[:, 1], unit_rotation_vectors[:, 2]
+    zeros = torch.zeros_like(xs)
+    K = torch.stack((zeros, -zs, ys,
+                     zs, zeros, -xs,
+                     -ys, xs, zeros), dim=1).reshape(-1, 3, 3)
+    vv_t = unit_rotation_vectors[:, :, None] * unit_rotation_vectors[:, None, :]
+
+    coss = torch.cos(angs_rads)[:, :, None]
+    sins = torch.sin(angs_rads)[:, :, None]
+    eye = torch.eye(3, device=unit_rotation_vectors.device, dtype=unit_rotation_vectors.dtype)
+    R = coss * eye + sins * K + (1.0 - coss) * vv_t
+    return R
 
-    def batch_scalar_to_3x3(data):
-        return data[:, :, None].repeat(1, 3, 3)
-
-    K = torch.zeros(unit_rotation_vectors.shape[0], 3, 3, device=device)
-
-    K[:, 0, 0] = 0.0
-    K[:, 0, 1] = -unit_rotation_vectors[:, 2]
-    K[:, 0, 2] = unit_rotation_vectors[:, 1]
-
-    K[:, 1, 0] = unit_rotation_vectors[:, 2]
-    K[:, 1, 1] = 0.0
-    K[:, 1, 2] = -unit_rotation_vectors[:, 0]
-
-    K[:, 2, 0] = -unit_rotation_vectors[:, 1]
-    K[:, 2, 1] = unit_rotation_vectors[:, 0]
-    K[:, 2, 2] = 0.0
 
-    a = torch.eye(3, device=device).repeat(unit_rotation_vectors.shape[0], 1, 1)
-    b = batch_scalar_to_3x3(torch.sin(angs_rads)) * K
-    c = batch_scalar_to_3x3(1.0 - torch.cos(angs_rads)) * K @ K
+def invert_calibration_matrix_torch(K):
+    """
+    Closed-form inverse of the (upper triangular) calibration matrix
+    :param K: torch.Tensor(3, 3) - [[fx, s, cx], [0, fy, cy], [0, 0, 1]]
+    :return: torch.Tensor(3, 3)
+    """
 
-    R = a + b + c
-    return R
+    fx, s, cx = K[0, 0], K[0, 1], K[0, 2]
+    fy, cy = K[1, 1], K[1, 2]
+    zero = torch.zeros_like(fx)
+    one = torch.ones_like(fx)
+    K_inv = torch.stack((1.0 / fx, -s / (fx * fy), (s * cy - cx * fy) / (fx * fy),
+                         zero, 1.0 / fy, -cy / fy,
+                         zero, zero, one)).reshape(3, 3)
+    return K_inv
 
 
-def get_rectification_rotations(normals, device=torch.device('cpu')):
+def get_rectification_rotations(normals, device=torch.device('cpu'), check_dets=False):
     """
     :param normals:
-    :param device:
+    :param device: unused - the rotations are created on the device (and with the dtype) of normals
+    :param check_dets: debug check that det(R) == 1 (one det per normal, so off by default)
     :return:
     """
 
     # now the normals will be "from" me, "inside" the surfaces
     normals = -normals
 
-    z = torch.tensor([[0.0, 0.0, 1.0]], device=device).repeat(normals.shape[0], 1)
+    z = torch.tensor([[0.0, 0.0, 1.0]], device=normals.device, dtype=normals.dtype).repeat(normals.shape[0], 1)
     assert torch.all(normals[:, 2] > 0)
 
     rotation_vectors = torch.cross(z, normals, dim=1)
@@ -56,14 +65,10 @@ def get_rectification_rotations(normals, device=torch.device('cpu')):
     unit_rotation_vectors = rotation_vectors / rotation_vector_norms
     thetas = torch.asin(rotation_vector_norms)
 
-    def check_R(R):
-        debug = True
-        if debug:
-            det = torch.linalg.det(R)
-            assert_small_error(det - 1.0, 1.0e-5, "|det - 1.0| < {}".format(1.0e-5), normals)
-
     R = get_rotation_matrices_torch(unit_rotation_vectors, thetas, device)
-    check_R(R)
+    if check_dets:
+        det = torch.linalg.det(R)
+        assert_small_error(det - 1.0, 1.0e-5, "|det - 1.0| < {}".format(1.0e-5), normals)
     return R
 
 
@@ -146,7 +151,7 @@ def t_get_rectification_rotations():
     # where rotation_vector_norms > 1.0.
     # Fixed by clamp(...,max=1.0)
     data = -torch.tensor([[8.0251e-01, -5.9664e-01,  1.5897e-04]])
-    get_rectification_rotations(data, device=torch.device('cpu'))
+    get_rectification_rotations(data, device=torch.device('cpu'), check_dets=True)
 
 
 def sanity_check_homographies_jacobians():
@@ -212,14 +212,49 @@ def append_update_stats_map_static(key_list, obj, map_in):
     map[key_list[-1]].append(obj)
 
 
+def merge_stats_map_static(map_from, map_in):
+    """
+    Merges the stats collected elsewhere (e.g. in a worker process) - the appended lists are extended, other values
+    are updated (see update_stats_map_static / append_update_stats_map_static)
+    :param map_from: the stats to merge
+    :param map_in: the stats to merge into
+    """
+    if map_in is None:
+        return
+    for key, value in map_from.items():
+        if isinstance(value, dict):
+            ensure_key(map_in, key)
+            merge_stats_map_static(value, map_in[key])
+        elif isinstance(value, list) and isinstance(map_in.get(key), list):
+            map_in[key].extend(value)
+        else:
+            map_in[key] = value
+
+
 def is_rectified_condition(img_data):
     return img_data.valid_components_dict is not None
 
 
+def kps_to_xy(kps):
+    """
+    :param kps: list of cv.KeyPoint
+    :return: np.ndarray(N, 2) of float32
+    """
+    return np.asarray(cv.KeyPoint_convert(kps), dtype=np.float32).reshape(-1, 2)
+
+
 def split_points(tentative_matches, kps1, kps2):
-    src_pts = np.float32([kps1[m.queryIdx].pt for m in tentative_matches]).reshape(-1, 2)
-    dst_pts = np.float32([kps2[m.trainIdx].pt for m in tentative_matches]).reshape(-1, 2)
-    return src_pts, dst_pts
+    """
+    :param tentative_matches: list of cv.DMatch
+    :param kps1: list of cv.KeyPoint or their coordinates as np.ndarray(N1, 2) (see kps_to_xy)
+    :param kps2: list of cv.KeyPoint or their coordinates as np.ndarray(N2, 2)
+    :return: src_pts(M, 2), dst_pts(M, 2) of float32
+    """
+    kps1_xy = kps1 if isinstance(kps1, np.ndarray) else kps_to_xy(kps1)
+    kps2_xy = kps2 if isinstance(kps2, np.ndarray) else kps_to_xy(kps2)
+    query_idx = np.fromiter((m.queryIdx for m in tentative_matches), dtype=np.int32, count=len(tentative_matches))
+    train_idx = np.fromiter((m.trainIdx for m in tentative_matches), dtype=np.int32, count=len(tentative_matches))
+    return kps1_xy[query_idx], kps2_xy[train_idx]
 
 
 def get_normals_stats(img_data_list, src_tentatives_2d, dst_tentatives_2d, mask=None):
@@ -291,16 +326,43 @@ def get_kpts_normals(components_indices, valid_components_dict, kpts_2d):
     kpts_2d = np.array(kpts_2d)
 
     # 'np.int32' avoids warning
-    kpts_ints = np.round(kpts_2d).astype(np.int32)
-
-    np.clip(kpts_ints[:, 0], 0, components_indices.shape[1] - 1, out=kpts_ints[:, 0])
-    np.clip(kpts_ints[:, 1], 0, components_indices.shape[0] - 1, out=kpts_ints[:, 1])
+    bounds = [components_indices.shape[1] - 1, components_indices.shape[0] - 1]
+    kpts_ints = np.clip(np.round(kpts_2d), 0, bounds).astype(np.int32)
 
     keypoints_components = components_indices[kpts_ints[:, 1], kpts_ints[:, 0]]
-    keypoints_normals = np.array([valid_components_dict.get(component, -1) for component in keypoints_components])
+    # component -> normal lookup table, -1 for the invalid components
+    lut = np.full(max(keypoints_components.max(initial=0), *valid_components_dict.keys(), 0) + 1, -1)
+    for component, normal in valid_components_dict.items():
+        lut[component] = normal
+    # the negative component ids (-1, -2, -3, see e.g. affnet_clustering.filter_components) are invalid as well - they
+    # mustn't wrap around the lut
+    keypoints_normals = np.where(keypoints_components >= 0, lut[np.maximum(keypoints_components, 0)], -1)
     return keypoints_normals
 
 
+def get_K_inv(K):
+    """
+    Closed form inverse of the (upper triangular) calibration matrix
+    :param K: np.ndarray(3, 3) with K[2] == [0, 0, 1]
+    :return: np.ndarray(3, 3)
+    """
+    fx, s, cx = K[0, 0], K[0, 1], K[0, 2]
+    fy, cy = K[1, 1], K[1, 2]
+    return np.array([
+        [1.0 / fx, -s / (fx * fy), (s * cy - cx * fy) / (fx * fy)],
+        [     0.0,       1.0 / fy,                       -cy / fy],
+        [     0.0,            0.0,                            1.0]
+    ])
+
+
+def vector_product_matrix(vec: np.ndarray):
+    return np.array([
+        [    0.0, -vec[2],  vec[1]],
+        [ vec[2],     0.0, -vec[0]],
+        [-vec[1],  vec[0],     0.0],
+    ])
+
+
 def get_rot_vec_deg(np_r):
     rot_vec = KG.rotation_matrix_to_angle_axis(torch.from_numpy(np_r)[None])[0].numpy()
     return np.rad2deg(rot_vec)
@@ -359,47 +421,20 @@ def get_rotation_matrices(unit_rotation_vector, theta):
     assert h == h2
     assert w == w2
 
-    K = np.zeros((h, w, 3, 3))
-    a = np.ndarray((h, w, 3, 3))
-    #b = np.ndarray((h, w, 3, 3))
-    c = np.ndarray((h, w, 3, 3))
-
-    zer = np.zeros((h, w))
-
     # Rodrigues formula
     # R = I + sin(theta) . K + (1 - cos(theta)).K**2
+    #   = cos(theta) . I + sin(theta) . K + (1 - cos(theta)) . v @ v^T  (as K**2 = v @ v^T - I for a unit v)
 
-    K[:, :, 0, 0] = 0
-    K[:, :, 0, 1] = -unit_rotation_vector[:, :, 2]
-    K[:, :, 0, 2] = unit_rotation_vector[:, :, 1]
-    K[:, :, 1, 0] = unit_rotation_vector[:, :, 2]
-    K[:, :, 1, 1] = 0
-    K[:, :, 1, 2] = -unit_rotation_vector[:, :, 0]
-    K[:, :, 2, 0] = -unit_rotation_vector[:, :, 1]
-    K[:, :, 2, 1] = unit_rotation_vector[:, :, 0]
-    K[:, :, 2, 2] = 0
-
-    # K[:, :] = np.array([
-    #     [zer, -unit_rotation_vector[:, :, 2], unit_rotation_vector[:, :, 1]],
-    #     [unit_rotation_vector[:, :, 2], zer, -unit_rotation_vector[:, :, 0]],
-    #     [-unit_rotation_vector[:, :, 1], unit_rotation_vector[:, :, 0], zer],
-    # ])
-    a[:, :] = np.eye(3)
-    sins = np.sin(theta[:, :])
-    sins = np.expand_dims(sins, axis=(2, 3))
-    b = sins * K
-    one_m_cos_theta = np.expand_dims(-(np.cos(theta) - 1.0), axis=(2, 3))
-    c[:, :] = one_m_cos_theta * K[:, :] @ K[:, :]
-
-    # R = get_rotation_matrix(unit_rotation_vector[0, 0], theta[0, 0])
-    # det = np.linalg.det(R)
-
-    # a_0 = a[0, 0]
-    # b_0 = b[0, 0]
-    # c_0 = c[0, 0]
-    # print("{},\n {},\n {}".format(a_0, b_0, c_0))
-
-    Rs = a + b + c
+    xs, ys, zs = unit_rotation_vector[:, :, 0], unit_rotation_vector[:, :, 1], unit_rotation_vector[:, :, 2]
+    zer = np.zeros((h, w))
+    K = np.stack((zer, -zs, ys,
+                  zs, zer, -xs,
+                  -ys, xs, zer), axis=2).reshape(h, w, 3, 3)
+    vv_t = unit_rotation_vector[:, :, :, None] * unit_rotation_vector[:, :, None, :]
+
+    coss = np.cos(theta)[:, :, None, None]
+    sins = np.sin(theta)[:, :, None, None]
+    Rs = coss * np.eye(3) + sins * K + (1.0 - coss) * vv_t
     return Rs
 
 
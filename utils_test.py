@@ -0,0 +1,21 @@
+import numpy as np
+
+from utils import get_kpts_normals
+
+
+def test_get_kpts_normals():
+    components_indices = np.array([[-1, 0],
+                                   [1, 1]])
+    valid_components_dict = {0: 0, 1: 5}
+    kpts_2d = [[0, 0], [1, 0], [0, 1]]
+
+    np.testing.assert_equal(get_kpts_normals(components_indices, valid_components_dict, kpts_2d), [-1, 0, 5])
+
+
+def test_get_kpts_normals_invalid_components():
+    # all the negative ids (see affnet_clustering.filter_components) and the components without a normal give -1
+    components_indices = np.array([[-3, -2, -1, 0, 1, 2]])
+    valid_components_dict = {0: 1, 2: 0}
+    kpts_2d = [[x, 0] for x in range(6)] + [[10.4, -3.0]]
+
+    np.testing.assert_equal(get_kpts_normals(components_indices, valid_components_dict, kpts_2d), [-1, -1, -1, 1, -1, 0, 0])